@@ -2,111 +2,513 @@ from .archive_object import ArchiveObject
 from .archive_data import ArchiveData
 from .archive_config import ArchiveConfig
 from .archive_entry import ArchiveEntry
-from .archive_index import ArchiveIndex
-import glob
+from .archive_index import ArchiveIndex, LazyArchiveIndex
+from .archive_pipeline import ArchivePipeline
+from .archive_verify import ArchiveVerifier, check_file
+from .archive_scrub import ArchiveScrubber
+from .archive_gc import ArchiveCollector
+from .archive_scan import ArchiveScanner
+from .archive_metrics import ArchiveMetrics, ArchiveProgress, human_readable
+from concurrent.futures import ProcessPoolExecutor, wait
+from collections import deque
 import os
-import fnmatch
-
-from math import log, log10, floor
-def human_readable(value):
-    suffix={
-        3: "kB",
-        6: "MB",
-        9: "GB",
-        12: "TB",
-        15: "PB"
-    }
-    elevel = (floor(log10(value))//3*3)
-    if elevel == 0:
-        return f"{value}B"
-    return f"{value / (10**elevel):.0f}{suffix[elevel]}"
-
+import shutil
+import sys
+import tarfile
+import threading
+import time
 
 class Archive:
-    def __init__(self, archivename, debug):
+    def __init__(self, archivename, debug, progress=False, config=None, backend=None):
         self.archivename = archivename
-        self.config = ArchiveConfig(archivename, debug)
-        self.objects = ArchiveObject(self.config)
-        self.data = ArchiveData(self.config)
-        self.index = ArchiveIndex(self.config, self.data)
+        self.config = config if config is not None else ArchiveConfig(archivename, debug)
+        self.metrics = ArchiveMetrics()
+        self.show_progress = progress
+        self.data = ArchiveData(self.config, self.metrics)
+        if self.config.lazyindex:
+            self.index = LazyArchiveIndex(self.config, self.data)
+        else:
+            self.index = ArchiveIndex(self.config, self.data)
+        # an existing archive keeps the hash algorithm it was created with
+        hashalg = self.data.read_hashalg(self.index.archive_id) if self.index.archive_id >= 0 else None
+        self.objects = ArchiveObject(self.config, self.index.all_hashes, self.data, hashalg, self.metrics, backend)
+
+    def progress(self, label, done, count=None):
+        """Returns the live progress line of a command, drawn on stderr if progress was requested.
+
+        Args:
+            label (str): The command name.
+            done (str): The metrics counter of bytes processed.
+            count (str): The metrics counter of items processed.
+        """
+        return ArchiveProgress(self.metrics, label, done, count, enabled=self.show_progress)
 
-    def backup(self):
+    def backup(self, full=False):
         """Create a backup of the specified directory.
 
         This method scans the local mirror directory for files and uploads them to the archive.
         It creates an archive entry for each file, which includes its path, size, and hash.
+        The mirror is walked by an ArchiveScanner on 'workers' threads, skipping the paths matched by the
+        'exclude' patterns, and files are stored while the walk is still running.
+
+        Backups are incremental by default: a file whose size, mtime, ctime and inode match the
+        stat cache of its stored entry is not opened, and its stored hash list is kept as is.
+        Changed and new files are re-chunked and their entries are upserted.
+
+        Each backup writes a new generation of the archive.  The entries of changed files are written as new
+        rows and the rows they replace are kept for the snapshots of earlier generations; files that are no
+        longer in the mirror are removed from the new generation once the scan completes, except those under
+        a directory that could not be read, which are kept as they were.  Unchanged entries are shared by all
+        generations.  The directory table used by dir() is rebuilt at the end of the backup.
+
+        Files are stored through an ArchivePipeline, configured by the 'workers' and 'maxbuffers'
+        settings, and their entries are written in scan order as each file completes.  Entries are
+        committed in batches ('batchentries', 'batchseconds'); an interrupted backup keeps the
+        entries committed so far and the next run picks up the rest, continuing the same generation.
+        The blobs uploaded are recorded with each commit, and at least every 'batchseconds' while a
+        large file is being stored, so the next run does not upload them again.
+
+        A backup holds a lease in the index database while it runs, and does not start while a garbage
+        collection is running.  The lease is renewed with each commit, and the open batch is committed at least
+        every 'batchseconds' while the scan goes over unchanged files, so that a long scan keeps the lease; a
+        lease left unrenewed for 'leaseexpire' seconds is taken as left by an interrupted run.
+
+        The bytes read, hashed, uploaded and deduplicated and the latencies of each stage are recorded in
+        the run's metrics, with a progress line that shows an ETA once the scan is complete.
+
+        Args:
+            full (bool): If True, re-chunk every file regardless of the stat cache.
 
         Side Effects:
-            Creates archive entries for each file in the local mirror directory.
+            Creates or updates archive entries for each file in the local mirror directory.
         """
+        lease = self.data.acquire_lease('backup', ('gc',), self.config.leaseexpire)
+        if lease is None:
+            print("backup: garbage collection is running, try again later")
+            return
+        try:
+            self._backup(full, lease)
+        finally:
+            self.data.release_lease(lease)
+
+    def _backup(self, full, lease):
         cfg = self.config
         obj = self.objects
         dat = self.data
-        archive_id = dat.write_archive(self.archivename)
-        for f in glob.glob(os.path.join(cfg.localmirror, "**"), recursive=True):
-            if os.path.isfile(f):
-                print(f)
-                entry = obj.put_file(archive_id, f)
-                dat.write_entry(entry)
+        index = self.index
+        archive_id = index.archive_id
+        if archive_id < 0:
+            archive_id = dat.write_archive(self.archivename, obj.hashalg)
+        generation = dat.write_generation(archive_id)
+        nchanged = 0
+        nunchanged = 0
+        scanned = False
+        scanner = ArchiveScanner(cfg.localmirror, cfg.exclude, cfg.workers)
+
+        def changed_files():
+            nonlocal nunchanged, scanned
+            seen = []
+            for f, st in scanner.scan():
+                libpath = obj.libpath(f)
+                seen.append(libpath)
+                if len(seen) >= cfg.batchentries:
+                    dat.mark_seen(seen)
+                    seen = []
+                    # commits the batch, renewing the lease, even if the files scanned are all unchanged
+                    writer.checkpoint()
+                prev = index.lookup(libpath)
+                if not full and prev is not None and ArchiveEntry.stat_matches(prev, st):
+                    nunchanged += 1
+                    continue
+                self.metrics.add('bytes_queued', st.st_size)
+                yield f
+            dat.mark_seen(seen)
+            scanned = True
+
+        def before_commit():
+            dat.write_packed(obj.flush_packs())
+            dat.write_stored(obj.take_uploaded())
+            dat.renew_lease(lease)
+
+        dat.begin_scan()
+        pipeline = ArchivePipeline(obj, cfg.workers, cfg.maxbuffers)
+        progress = self.progress("backup", 'bytes_read', 'blobs_hashed')
+        progress.set_total(lambda: self.metrics.get('bytes_queued') if scanned else None)
+        with progress, dat.writer(cfg.batchentries, cfg.batchseconds, before_commit, generation) as writer:
+            for entry in pipeline.put_files(archive_id, changed_files(), writer.checkpoint):
+                progress.print(entry.libpath)
+                prev = index.lookup(entry.libpath)
+                if prev is not None:
+                    entry.id = prev['id']
+                writer.write_entry(entry)
+                nchanged += 1
+        assert(scanned)
+        for path, msg in scanner.errors:
+            print(f"backup: skipped unreadable directory {path}: {msg}")
+        # the files under an unreadable directory are kept as they were, rather than removed
+        dat.mark_seen_under(archive_id, scanner.unread)
+        nremoved = dat.close_unseen(archive_id, generation)
+        dat.finish_generation(generation)
+        dat.build_dirs(archive_id)
+        self.metrics.add('files_stored', nchanged)
+        self.metrics.add('files_unchanged', nunchanged)
+        self.metrics.add('files_removed', nremoved)
+        self.metrics.add('files_excluded', scanner.nexcluded)
+        print(f"backup: generation {generation}, {nchanged} files stored, {nunchanged} unchanged, {nremoved} removed, {scanner.nexcluded} excluded")
+        print(f"backup: index {writer.entries_written} entries in {writer.commits} commits, {writer.elapsed:.2f}s ({writer.entries_per_second:.0f} entries/s)")
+        print(f"backup: {human_readable(obj.bytes_uploaded)} uploaded, {human_readable(obj.bytes_deduped)} deduplicated, {human_readable(obj.bytes_stored)} stored")
+
+    def gc(self, dry_run=False, keep=None):
+        """Prune old generations, then delete the objects in the object store that no entry references any more.
+
+        Only the 'keepgenerations' most recent finished generations are kept.  The older generations are deleted,
+        with the entry rows of old versions of modified and removed files that only their snapshots contain, so
+        the blobs of those versions become unreferenced.  Objects are deleted once they have stayed unreferenced
+        for 'gcgrace' seconds, as seen by two runs, so the first run after files are changed or removed only marks
+        their old blobs.  Garbage collection does not start while a backup is running, and backups do not start
+        while it runs; its lease is renewed every 'batchseconds' while objects are deleted.
+
+        Args:
+            dry_run (bool): If True, only count the generations that would be pruned and list the objects that would
+                be deleted.
+            keep (int): The number of generations to keep.  Defaults to 'keepgenerations'.
+
+        Side Effects:
+            Deletes old generations from the index, and unreferenced objects from the object store and the index.
+        """
+        cfg = self.config
+        dat = self.data
+        keep = keep if keep is not None else cfg.keepgenerations
+        lease = dat.acquire_lease('gc', ('gc', 'backup'), cfg.leaseexpire)
+        if lease is None:
+            print("gc: a backup or garbage collection is running, try again later")
+            return
+        try:
+            if self.index.archive_id >= 0:
+                ngenerations, nentries = dat.prune_generations(self.index.archive_id, keep, dry_run)
+                verb = "would prune" if dry_run else "pruned"
+                print(f"gc: {verb} {ngenerations} generations older than the last {keep}, {nentries} old file versions")
+            collector = ArchiveCollector(self.objects, dat, cfg.gcgrace)
+            progress = self.progress("gc", 'bytes_freed', 'objects_deleted')
+            progress.set_total(lambda: collector.ntotal, 'objects_deleted')
+            renewed = time.monotonic()
+            with progress:
+                for hash, size, msg in collector.collect(dry_run):
+                    if time.monotonic() - renewed >= cfg.batchseconds:
+                        dat.renew_lease(lease)
+                        renewed = time.monotonic()
+                    if msg is not None:
+                        progress.print(f"FAILED: {hash} {msg}")
+                    elif dry_run:
+                        progress.print(f"orphan: {hash} ({human_readable(size or 0)})")
+            marked, packed = dat.count_orphans()
+            verb = "would delete" if dry_run else "deleted"
+            print(f"gc: {collector.nmarked} newly unreferenced, {verb} {collector.ndeleted} objects ({human_readable(collector.bytes_freed)}), {collector.nfailed} failed")
+            print(f"gc: {marked} unreferenced objects kept, {human_readable(packed)} unreferenced in packs")
+        finally:
+            dat.release_lease(lease)
 
     def has_blob(self, hash):
         return self.index.has_hash(hash)
     
-    def verify(self, pattern="*"):
+    def verify(self, pattern="*", quick=False, resume=False):
         """Verify the integrity of the local directory by checking the hashes of stored files.
 
-        This method retrieves all entries from the archive index and verifies that each blob's hash matches the expected value.
+        A deep verify (the default) rehashes every local file and compares it with the hash list of its entry.
+        Files are hashed on a pool of 'workers' processes, and the progress of the run is checkpointed in the
+        index database so that an interrupted verify can be resumed.
+
+        A quick verify only compares the size and mtime of each local file with the stat cache of its entry,
+        and flags the files that have drifted without reading them.
 
         Args:
             pattern (str): A pattern to filter which files to verify. Defaults to "*", which verifies all files.
+                The literal prefix of the pattern is looked up in the sorted index, or in the database with the lazy index.
+            quick (bool): If True, compare stat metadata instead of rehashing.
+            resume (bool): If True, continue an interrupted deep verify of the same pattern from its checkpoint.
 
         Side Effects:
             Prints the verification status of each file to standard output.
         """
-        obj = self.objects
-        archive_id = self.index.archive_id
-        ihashes = self.index.ihashes
-        entries = self.index.entries
-        for e in entries:
-            lpath = entries[e]['libpath']
-            size = entries[e]['size']
-            fsize = os.fstat(lpath).st_size if os.path.isfile(lpath) else None
-            if pattern and not fnmatch.fnmatch(lpath, pattern):
-                continue
-
-            entry_id = entries[e]['id']
-            hashes = ihashes[entry_id]
-            ok = obj.verify_file(ArchiveEntry(archive_id, lpath, hashes, size, entry_id))
-            if ok:
-                print(f"OK:     {lpath} ({human_readable(size)})")
-
-    def restore(self, pattern="*"):
+        cfg = self.config
+        verifier = ArchiveVerifier(self.objects, self.data, self.index.archive_id, cfg.workers)
+        total = 0
+        listed = False
+
+        def entries():
+            nonlocal total, listed
+            for entry in self.index.iter_entries(pattern):
+                total += entry.size
+                yield entry
+            listed = True
+
+        results = verifier.quick(entries()) if quick else verifier.deep(entries(), pattern, resume)
+        progress = self.progress("verify", 'bytes_verified', 'files_verified')
+        progress.set_total(lambda: total if listed else None)
+        with progress:
+            for entry, msg in results:
+                if msg is None:
+                    progress.print(f"OK:     {entry.libpath} ({human_readable(entry.size)})")
+                else:
+                    progress.print(f"FAILED: {msg}")
+        self.metrics.add('files_failed', verifier.nfailed)
+        summary = f"verify: {verifier.nfiles} files, {human_readable(verifier.nbytes)}, {verifier.nfailed} failed, {verifier.elapsed:.2f}s"
+        if not quick:
+            summary += f" ({human_readable(int(verifier.bytes_per_second))}/s)"
+        print(summary)
+
+    def scrub(self, percent=100.0):
+        """Verify the blobs stored in the object store by fetching them and recomputing their hashes.
+
+        Blobs are fetched on 'workers' threads, limited to 'scrubrate' bytes per second if it is set.  Each run
+        checks the blobs that have gone longest without a scrub, so scrubbing a few percent per run rotates
+        through the whole archive.
+
+        Args:
+            percent (float): The percentage of the archive's distinct blobs to check.
+
+        Side Effects:
+            Prints each damaged blob with the files that reference it, and records the results in the index.
+        """
+        cfg = self.config
+        if self.index.archive_id < 0:
+            print(f"scrub: archive {self.archivename} is empty")
+            return
+        scrubber = ArchiveScrubber(self.objects, self.data, self.index.archive_id, cfg.workers, cfg.scrubrate)
+        progress = self.progress("scrub", 'bytes_downloaded', 'blobs_scrubbed')
+        progress.set_total(lambda: scrubber.ntotal, 'blobs_scrubbed')
+        with progress:
+            for hash, msg in scrubber.scrub(percent / 100.0):
+                if msg is not None:
+                    progress.print(f"FAILED: {msg}")
+                    for libpath in self.data.read_hash_libpaths(self.index.archive_id, hash):
+                        progress.print(f"        {libpath}")
+        self.metrics.add('blobs_failed', scrubber.nfailed)
+        print(f"scrub: {scrubber.nblobs} blobs, {human_readable(scrubber.nbytes)} read, {scrubber.nfailed} failed, {scrubber.elapsed:.2f}s ({human_readable(int(scrubber.bytes_per_second))}/s)")
+
+    def restore(self, pattern="*", generation=None, quick=False):
         """Restore the contents of the archive.
 
-        This method retrieves all entries from the archive index and restores them to the local filesystem.
+        This method retrieves all entries from the archive index that match the pattern and restores them to
+        the local filesystem.  Blobs are fetched concurrently through an ArchivePipeline.
+
+        Files that already match their entry are skipped: those with the archived size whose contents hash to the
+        entry's hash list, or with quick, those with the archived size and mtime, as a quick verify would.  The
+        files are rehashed on a pool of 'workers' processes, a few files ahead of the fetches, as a deep verify
+        would, so the fetches of the files to restore keep going while they are checked.  The parts written are
+        journaled in the index database every 'batchentries' parts or 'batchseconds' seconds, after the files are
+        synced, so a rerun of an interrupted restore only fetches the parts that are missing.  The journal rows of
+        the files this run completes are then removed, and those of other interrupted restores are kept.
+
+        Args:
+            pattern (str): A pattern to filter which files to restore. Defaults to "*", which restores all files.
+            generation (int): The generation to restore the files of.  Defaults to the current entries.
+            quick (bool): If True, skip files by size and mtime without rehashing them.
+
+        Blobs are read through the local blob cache if 'cachedir' is configured, so repeated restores of the same
+        content only fetch it from the object store once.
 
         Side Effects:
-            Restores files to their original locations on the filesystem.
+            Restores files to their original locations on the filesystem, with the mtime they were archived with.
         """
+        cfg = self.config
+        dat = self.data
         obj = self.objects
-        archive_id = self.index.archive_id
-        ihashes = self.index.ihashes
-        entries = self.index.entries
-        for e in entries:
-            lpath = entries[e]['libpath']
-            size = entries[e]['size']
-            if size == 0:
-                entry = ArchiveEntry(archive_id, lpath, [], 0, entries[e]['id'])
-                obj.get_file(entry)
-                continue
-            if pattern and not fnmatch.fnmatch(lpath, pattern):
-                continue
-            entry_id = entries[e]['id']
-            hashes = ihashes[entry_id]
-            print(lpath)
-            entry = ArchiveEntry(archive_id, lpath, hashes, entries[e]['size'], entry_id)
-            obj.get_file(entry)
+        if generation is not None and dat.read_generation(self.index.archive_id, generation) is None:
+            print(f"restore: no generation {generation}")
+            return
+        nrestored = 0
+        nskipped = 0
+        journal = []    # (entry id, part, path) written since the last flush
+        completed = []  # ids of the entries restored or up to date since the last flush
+        lock = threading.Lock()  # guards completed, which the pipeline's listing thread appends to
+        last_flush = time.monotonic()
+        total = 0
+        listed = False
+
+        def needed():
+            nonlocal nskipped, total, listed
+            pending = deque()   # (entry, future of the check of its local file, or None if it must be restored)
+
+            def skip(entry):
+                nonlocal nskipped
+                with lock:
+                    completed.append(entry.id)
+                nskipped += 1
+
+            def drain(block : bool):
+                nonlocal total
+                while pending and (block or pending[0][1] is None or pending[0][1].done()):
+                    entry, future = pending.popleft()
+                    if future is not None and future.result() is None:
+                        path = obj.localpath(entry.libpath)
+                        if entry.mtime_ns is not None and os.stat(path).st_mtime_ns != entry.mtime_ns:
+                            os.utime(path, ns=(entry.mtime_ns, entry.mtime_ns))
+                        skip(entry)
+                        continue
+                    total += entry.size
+                    yield entry
+
+            with ProcessPoolExecutor(cfg.workers) as pool:
+                for entry in self.index.iter_entries(pattern, generation):
+                    path = obj.localpath(entry.libpath)
+                    future = None
+                    if os.path.isfile(path) and os.stat(path).st_size == entry.size:
+                        if quick and entry.mtime_ns is not None and os.stat(path).st_mtime_ns == entry.mtime_ns:
+                            skip(entry)
+                            continue
+                        future = pool.submit(check_file, path, entry.size, list(entry.parts()), obj.hashalg)
+                    pending.append((entry, future))
+                    # keep a few files queued per process, without reading ahead through the whole index
+                    if len(pending) >= 4 * cfg.workers and pending[0][1] is not None:
+                        wait([pending[0][1]])
+                    yield from drain(block=False)
+                yield from drain(block=True)
+            listed = True
+
+        def flush():
+            nonlocal last_flush
+            for path in { path for _id, _part, path in journal }:
+                fd = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            dat.write_restored_parts([(id, part) for id, part, _path in journal])
+            with lock:
+                ids = completed[:]
+                completed.clear()
+            dat.clear_restored_parts(ids)
+            journal.clear()
+            last_flush = time.monotonic()
+
+        def on_written(entry, part):
+            journal.append((entry.id, part, obj.localpath(entry.libpath)))
+            if len(journal) >= cfg.batchentries or time.monotonic() - last_flush >= cfg.batchseconds:
+                flush()
+
+        pipeline = ArchivePipeline(obj, cfg.workers, cfg.maxbuffers)
+        progress = self.progress("restore", 'bytes_written', 'blobs_downloaded')
+        # the total is known once the pipeline has listed every entry
+        progress.set_total(lambda: total - self.metrics.get('bytes_resumed') if listed else None)
+        try:
+            with progress:
+                for entry in pipeline.get_files(needed(), lambda entry: dat.read_restored_parts(entry.id), on_written):
+                    if entry.mtime_ns is not None:
+                        os.utime(obj.localpath(entry.libpath), ns=(entry.mtime_ns, entry.mtime_ns))
+                    with lock:
+                        completed.append(entry.id)
+                    nrestored += 1
+                    progress.print(entry.libpath)
+        finally:
+            flush()
+        self.metrics.add('files_restored', nrestored)
+        self.metrics.add('files_skipped', nskipped)
+        print(f"restore: {nrestored} files restored, {nskipped} already up to date")
+        if obj.cache is not None:
+            cache = obj.cache
+            print(f"restore: cache {cache.hits} hits ({human_readable(cache.bytes_hit)}), {cache.misses} misses, {cache.evictions} evicted, {human_readable(cache.size)} cached")
+
+    def cat(self, pattern, generation=None, out=None):
+        """Write the contents of the archived files matching a pattern, one after the other, without restoring them.
+
+        Files are read straight from the object store, so nothing is written to the local mirror.
+
+        Args:
+            pattern (str): The pattern of the files to write.  A library path writes that single file.
+            generation (int): The generation to read the files of.  Defaults to the current entries.
+            out: The binary stream written to.  Defaults to standard output.
+
+        Returns:
+            int: The number of files written.
+        """
+        out = out if out is not None else sys.stdout.buffer
+        nfiles = 0
+        if generation is not None and self.data.read_generation(self.index.archive_id, generation) is None:
+            return nfiles
+        for entry in self.index.iter_entries(pattern, generation):
+            with self.objects.open_entry(entry) as f:
+                shutil.copyfileobj(f, out, 1024*1024)
+            nfiles += 1
+        out.flush()
+        return nfiles
 
+    def export(self, pattern="*", generation=None, out=None, compression=""):
+        """Write the archived files matching a pattern as a tar stream, without restoring them.
+
+        Files are read straight from the object store one at a time, and the tar stream is written as they are
+        read, so neither the files nor the archive are materialized on local disk.  Entries carry the library
+        path, size and archived mtime of each file.
+
+        Args:
+            pattern (str): The pattern of the files to export.  Defaults to "*", all files.
+            generation (int): The generation to export the files of.  Defaults to the current entries.
+            out: The binary stream the tar is written to.  Defaults to standard output.
+            compression (str): '' for an uncompressed tar, or 'gz', 'bz2' or 'xz'.
+
+        Side Effects:
+            Prints a summary to standard error, which stays free of the tar stream.
+        """
+        if generation is not None and self.data.read_generation(self.index.archive_id, generation) is None:
+            print(f"export: no generation {generation}", file=sys.stderr)
+            return
+        out = out if out is not None else sys.stdout.buffer
+        nfiles = 0
+        nbytes = 0
+        progress = self.progress("export", 'bytes_exported', 'files_exported')
+        with progress, tarfile.open(fileobj=out, mode=f"w|{compression}") as tar:
+            for entry in self.index.iter_entries(pattern, generation):
+                info = tarfile.TarInfo(entry.libpath)
+                info.size = entry.size
+                info.mtime = entry.mtime_ns // 10**9 if entry.mtime_ns is not None else int(time.time())
+                info.mode = 0o644
+                with self.objects.open_entry(entry) as f:
+                    tar.addfile(info, f)
+                nfiles += 1
+                nbytes += entry.size
+                self.metrics.add('files_exported')
+                self.metrics.add('bytes_exported', entry.size)
+        out.flush()
+        print(f"export: {nfiles} files, {human_readable(nbytes)}", file=sys.stderr)
+
+    def generations(self):
+        """List the generations of the archive.
+
+        Side Effects:
+            Prints each generation with its start time and the number of entries it added and removed.
+        """
+        for g in self.data.read_generations(self.index.archive_id):
+            started = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(g['started']))
+            state = "" if g['finished'] is not None else " (unfinished)"
+            print(f"{g['id']:>6d} {started} +{g['added']} -{g['removed']}{state}")
+
+    def diff(self, old=None, new=None):
+        """List the files that differ between the snapshots of two generations.
+
+        Args:
+            old (int): The earlier generation.  Defaults to the parent of new.
+            new (int): The later generation.  Defaults to the latest finished generation.
+
+        Side Effects:
+            Prints each added (A), deleted (D) or modified (M) file to standard output.
+        """
+        dat = self.data
+        archive_id = self.index.archive_id
+        newgen = dat.read_generation(archive_id, new)
+        if newgen is None:
+            print(f"diff: no generation {new if new is not None else ''}".rstrip())
+            return
+        old = old if old is not None else newgen['parent']
+        if old is None:
+            old = 0  # the first generation, or the oldest one kept, is compared with an empty archive
+        elif old > 0 and dat.read_generation(archive_id, old) is None:
+            print(f"diff: no generation {old}")
+            return
+        for row in dat.diff_generations(archive_id, min(old, newgen['id']), max(old, newgen['id'])):
+            change = row['change']
+            if old > newgen['id']:
+                change = { 'A': 'D', 'D': 'A', 'M': 'M' }[change]
+            print(f"{change} {row['libpath']}")
 
     def dir(self, ldir):
         """List the contents of a directory in the archive.
@@ -117,25 +519,20 @@ class Archive:
         Side Effects:
             Prints the contents of the directory to standard output.
         """
-        entryids, directories = self.index.idir(ldir)
-        for id in entryids:
-            e = self.index.entries[id]
+        entries, directories = self.index.idir(ldir)
+        for e in entries:
             print(f"{human_readable(e['size']):>10s} {e['libpath']}")
-        for lpath in directories:
-            print(f"{'[dir]':>10s} {lpath}")
+        for d in directories:
+            print(f"{human_readable(d['size']):>10s} {d['path']}/ [{d['nfiles']} files]")
     
     def find(self, pattern):
         """Find files in the archive matching a given pattern.
 
         Args:
-            pattern (str): The pattern to match file paths against.
+            pattern (str): The pattern to match file paths against.  Matching is case sensitive.
 
         Side Effects:
             Prints the matching file paths to standard output.
         """
-        import fnmatch
-        entries = self.index.entries
-        for e in entries:
-            lpath = entries[e]['libpath']
-            if fnmatch.fnmatch(lpath, pattern):
-                print(lpath)
+        for e in self.index.find(pattern):
+            print(e['libpath'])
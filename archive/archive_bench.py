@@ -0,0 +1,339 @@
+from contextlib import redirect_stdout
+from typing import List
+import copy
+import gc
+import io
+import json
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+from .archive import Archive
+from .archive_config import ArchiveConfig
+from .archive_metrics import human_readable
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+class SyntheticCorpus:
+    def __init__(self, root : str, files : int = 1000, size : int = 256*1024, dup : float = 0.1, seed : int = 1,
+                 fanout : int = 32):
+        """A reproducible mirror of random files for benchmarks.
+
+        File sizes are drawn from an exponential distribution with the given mean, so most files are small and a
+        few are large.  A dup fraction of the files are copies of an earlier file, which backup deduplicates.  The
+        files are spread over two levels of fanout directories.  The same seed always produces the same corpus.
+
+        Args:
+            root (str): The directory the corpus is written to, the local mirror of the benchmark archive.
+            files (int): The number of files.
+            size (int): The mean file size in bytes.
+            dup (float): The fraction of files that duplicate another file.
+            seed (int): The random seed.
+            fanout (int): The number of subdirectories per directory.
+        """
+        self.root = root
+        self.files = files
+        self.size = size
+        self.dup = dup
+        self.seed = seed
+        self.fanout = fanout
+        self.paths : List[str] = []  # library paths of the files
+        self.nbytes = 0
+
+    def dirs(self) -> List[str]:
+        """Returns the library paths of the directories that contain files, and the root."""
+        return [""] + sorted({ libpath.rsplit("/", 1)[0] for libpath in self.paths })
+
+    def generate(self):
+        """Writes the corpus to the root directory."""
+        rng = random.Random(self.seed)
+        for i in range(self.files):
+            libpath = f"d{i % self.fanout:02d}/s{i // self.fanout % self.fanout:02d}/f{i:07d}.bin"
+            path = os.path.join(self.root, libpath)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if self.paths and rng.random() < self.dup:
+                shutil.copyfile(os.path.join(self.root, rng.choice(self.paths)), path)
+            else:
+                with open(path, "wb") as f:
+                    f.write(rng.randbytes(min(int(rng.expovariate(1 / self.size)), 64 * self.size)))
+            self.paths.append(libpath)
+            self.nbytes += os.path.getsize(path)
+
+    def modify(self, rate : float) -> int:
+        """Overwrites 4KiB at a random offset of a rate fraction of the files, as a day of edits would.
+
+        Returns:
+            int: The number of files modified.
+        """
+        rng = random.Random(self.seed + 1)
+        changed = rng.sample(self.paths, round(len(self.paths) * rate))
+        for libpath in changed:
+            path = os.path.join(self.root, libpath)
+            size = os.path.getsize(path)
+            with open(path, "r+b") as f:
+                f.seek(rng.randrange(size) if size > 0 else 0)
+                f.write(rng.randbytes(4096))
+        return len(changed)
+
+
+class MemoryObject:
+    def __init__(self, store, path : str):
+        self.store = store
+        self.path = path
+
+    def put_bytes(self, data : bytes):
+        self.store.delay(len(data))
+        self.store.objects[self.path] = bytes(data)
+
+    def get_bytes(self) -> bytes:
+        data = self.store.objects[self.path]
+        self.store.delay(len(data))
+        return data
+
+    def exists(self) -> bool:
+        self.store.delay(0)
+        return self.path in self.store.objects
+
+    def delete(self):
+        self.store.delay(0)
+        del self.store.objects[self.path]
+
+
+class MemoryBackend:
+    def __init__(self, latency : float = 0.0, bandwidth : float = 0.0, faults : float = 0.0, seed : int = 1):
+        """An in-memory stand-in for a multicloud object store that adds the latency and transfer time of a remote
+        store to every request, so that the overlap of transfers can be measured without a network, and can fail
+        a share of the requests with a transient error, to exercise the retries of ArchiveStore.
+
+        Args:
+            latency (float): Seconds added to every request.
+            bandwidth (float): Bytes per second of each transfer, or 0 for no limit.
+            faults (float): The probability that a request fails with a ConnectionError, without effect.
+            seed (int): The random seed of the faults.
+        """
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.faults = faults
+        self.rng = random.Random(seed)
+        self.objects = {}  # path -> contents
+        self.requests = 0
+        self.failed = 0
+        self.lock = threading.Lock()
+
+    def delay(self, nbytes : int):
+        """Waits for the time a request would take, and raises the injected faults."""
+        with self.lock:
+            self.requests += 1
+            fail = self.faults > 0 and self.rng.random() < self.faults
+            if fail:
+                self.failed += 1
+        seconds = self.latency + (nbytes / self.bandwidth if self.bandwidth > 0 else 0.0)
+        if seconds > 0:
+            time.sleep(seconds)
+        if fail:
+            raise ConnectionError("injected fault")
+
+    def object(self, path : str) -> MemoryObject:
+        return MemoryObject(self, path)
+
+
+def reset_peak_rss():
+    """Resets the peak resident set size of this process, where the OS allows it (Linux)."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss() -> int:
+    """Returns the peak resident set size of this process in bytes, since the last reset_peak_rss() on Linux and
+    since the start of the process elsewhere, or None if it is not available.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+# the counters of bytes and files, and the latency histogram, that each kind of phase is measured by
+PHASE_METRICS = {
+    "backup": ('bytes_read', ('files_stored', 'files_unchanged'), 'put_blob'),
+    "restore": ('bytes_written', ('files_restored',), 'get_blob'),
+    "verify": ('bytes_verified', ('files_verified',), None),
+    "index": (None, ('entries_listed',), 'sqlite'),
+}
+
+
+class ArchiveBenchmark:
+    def __init__(self, workdir : str, corpus : SyntheticCorpus, settings : dict = None, backend = None):
+        """Runs the archive commands on a synthetic corpus and measures each one.
+
+        Each phase opens the archive afresh, as a run of arc would, and its time includes loading the index.  The
+        peak RSS of a phase includes the objects held by the in-memory backend; use the 'local' backend when
+        comparing memory use.  Deep verify hashes on worker processes, whose memory is not counted.
+
+        Args:
+            workdir (str): The directory holding the mirror, the index database and the local object store.
+            corpus (SyntheticCorpus): The corpus, generated in workdir/mirror.
+            settings (dict): Archive settings to benchmark, as in config.yaml.  The mirror, index, objectstore and
+                cache directories are replaced by ones in workdir.
+            backend: An object store to use instead of the 'local' multicloud backend, such as a MemoryBackend.
+        """
+        self.workdir = workdir
+        self.corpus = corpus
+        self.backend = backend
+        self.settings = copy.deepcopy(settings) if settings is not None else {}
+        self.settings.setdefault('verifyreads', False)
+        self.settings['mirrors'] = { socket.gethostname(): corpus.root }
+        self.settings['index'] = { 'database': os.path.join(workdir, "index", "archive.db") }
+        self.settings['objectstore'] = { 'backend': { 'type': 'local', 'basedir': os.path.join(workdir, "store") } }
+        if self.settings.get('cachedir'):
+            self.settings['cachedir'] = os.path.join(workdir, "cache")
+        self.results : List[dict] = []
+
+    def phase(self, name : str, kind : str, run, prepare=None) -> dict:
+        """Runs one phase and records its result.
+
+        Args:
+            name (str): The name of the phase in the results.
+            kind (str): The kind of phase, a key of PHASE_METRICS.
+            run (callable): Called with the Archive to do the measured work, with stdout discarded.
+            prepare (callable): Called before the phase, outside the measurement.
+        """
+        if prepare is not None:
+            prepare()
+        gc.collect()
+        reset_peak_rss()
+        t0 = time.perf_counter()
+        with redirect_stdout(io.StringIO()):
+            arc = Archive("bench", False, config=ArchiveConfig("bench", settings=self.settings), backend=self.backend)
+            run(arc)
+        seconds = time.perf_counter() - t0
+        arc.data.close()
+        m = arc.metrics
+        bytes_counter, files_counters, stage = PHASE_METRICS[kind]
+        nbytes = m.get(bytes_counter) if bytes_counter is not None else 0
+        nfiles = sum(m.get(c) for c in files_counters)
+        latency = m.histograms[stage].summary() if stage in m.histograms else None
+        result = {
+            "phase": name,
+            "seconds": round(seconds, 3),
+            "files": nfiles,
+            "bytes": nbytes,
+            "bytes_per_second": round(nbytes / seconds) if seconds > 0 else 0,
+            "files_per_second": round(nfiles / seconds, 1) if seconds > 0 else 0,
+            "stage": stage,
+            "p50": latency['p50'] if latency is not None else None,
+            "p95": latency['p95'] if latency is not None else None,
+            "sqlite_seconds": round(m.seconds('sqlite'), 3),
+            "retries": m.get('store_retries'),
+            "peak_rss": peak_rss(),
+        }
+        self.results.append(result)
+        return result
+
+    def run(self, modify : float = 0.05) -> List[dict]:
+        """Runs the benchmark phases in order: a full backup, an unchanged and a modified incremental backup,
+        directory listings and searches, quick and deep verify, and a restore of the whole mirror.
+
+        Args:
+            modify (float): The fraction of files modified before the incremental backup.
+
+        Raises:
+            AssertionError: If the restore does not bring back every file of the corpus.
+        """
+        corpus = self.corpus
+
+        def list_dirs(arc):
+            for d in corpus.dirs():
+                entries, directories = arc.index.idir(d)
+                arc.metrics.add('entries_listed', len(entries) + len(directories))
+
+        def find(arc):
+            for pattern in ("*.bin", "d01/*", "*f00001*"):
+                for _row in arc.index.find(pattern):
+                    arc.metrics.add('entries_listed')
+
+        self.phase("backup", "backup", lambda arc: arc.backup())
+        self.phase("backup unchanged", "backup", lambda arc: arc.backup())
+        self.phase("backup modified", "backup", lambda arc: arc.backup(), lambda: corpus.modify(modify))
+        self.phase("dir", "index", list_dirs)
+        self.phase("find", "index", find)
+        self.phase("verify quick", "verify", lambda arc: arc.verify(quick=True))
+        self.phase("verify", "verify", lambda arc: arc.verify())
+        result = self.phase("restore", "restore", lambda arc: arc.restore(),
+                            lambda: shutil.rmtree(corpus.root))
+        assert result["files"] == len(corpus.paths), f"restored {result['files']} of {len(corpus.paths)} files"
+        return self.results
+
+    def print_results(self):
+        """Prints the results as a table."""
+        print(f"{'phase':<18s} {'seconds':>8s} {'files':>7s} {'files/s':>8s} {'bytes/s':>8s} {'stage':>9s} "
+              f"{'p50 ms':>7s} {'p95 ms':>7s} {'sqlite s':>8s} {'retries':>7s} {'peak RSS':>8s}")
+        for r in self.results:
+            p50 = f"{r['p50']*1000:.2f}" if r['p50'] is not None else "-"
+            p95 = f"{r['p95']*1000:.2f}" if r['p95'] is not None else "-"
+            rss = human_readable(r['peak_rss']) if r['peak_rss'] is not None else "-"
+            print(f"{r['phase']:<18s} {r['seconds']:>8.2f} {r['files']:>7d} {r['files_per_second']:>8.0f} "
+                  f"{human_readable(r['bytes_per_second']) + '/s':>8s} {r['stage'] or '-':>9s} {p50:>7s} {p95:>7s} "
+                  f"{r['sqlite_seconds']:>8.2f} {r['retries']:>7d} {rss:>8s}")
+
+
+def benchmark(settings : dict = None, files : int = 1000, size : int = 256*1024, dup : float = 0.1,
+              modify : float = 0.05, seed : int = 1, backend : str = "memory", latency : float = 0.0,
+              bandwidth : float = 0.0, faults : float = 0.0, workdir : str = None, results : str = None):
+    """Generates a synthetic corpus, runs the benchmark phases on it and prints a table of the results.
+
+    Args:
+        settings (dict): Archive settings to benchmark, as in config.yaml, or None for the defaults.
+        files (int): The number of files in the corpus.
+        size (int): The mean file size in bytes.
+        dup (float): The fraction of duplicate files.
+        modify (float): The fraction of files modified before the incremental backup.
+        seed (int): The random seed of the corpus.
+        backend (str): 'memory' for the in-memory store with injected latency, or 'local' for the multicloud
+            local backend in the work directory.
+        latency (float): Seconds added to each request to the in-memory store.
+        bandwidth (float): Bytes per second of each transfer to the in-memory store, or 0 for no limit.
+        faults (float): The share of requests to the in-memory store that fail with a transient error.
+        workdir (str): The work directory, kept after the run.  Defaults to a temporary directory that is removed.
+        results (str): A file the parameters and results are appended to as a line of JSON, for comparing runs.
+    """
+    tmpdir = None
+    if workdir is None:
+        workdir = tmpdir = tempfile.mkdtemp(prefix="arcbench")
+    elif os.path.exists(workdir) and len(os.listdir(workdir)) > 0:
+        raise ValueError(f"Benchmark work directory {workdir} is not empty")
+    try:
+        corpus = SyntheticCorpus(os.path.join(workdir, "mirror"), files, size, dup, seed)
+        t0 = time.perf_counter()
+        corpus.generate()
+        print(f"bench: {files} files, {human_readable(corpus.nbytes)} generated in {time.perf_counter() - t0:.2f}s, "
+              f"{dup:.0%} duplicates, {modify:.0%} modified, {backend} backend")
+        store = MemoryBackend(latency, bandwidth, faults, seed) if backend == "memory" else None
+        bench = ArchiveBenchmark(workdir, corpus, settings, store)
+        bench.run(modify)
+        bench.print_results()
+        if results is not None:
+            params = { "files": files, "size": size, "dup": dup, "modify": modify, "seed": seed, "backend": backend,
+                       "latency": latency, "bandwidth": bandwidth, "faults": faults, "settings": bench.settings }
+            with open(results, "at") as f:
+                f.write(json.dumps({ "time": int(time.time()), "params": params, "results": bench.results }) + "\n")
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir, ignore_errors=True)
@@ -0,0 +1,126 @@
+from collections import OrderedDict
+import os
+import threading
+import time
+
+
+class ArchiveCache:
+    def __init__(self, path : str, maxsize : int, hasher):
+        """Initialize an on-disk, content addressed cache of blobs read from the object store.
+
+        Blobs are kept decoded under their hash, so every read is checked by rehashing the cached file, and a
+        damaged or truncated file is dropped and counted as a miss.  The cache holds at most maxsize bytes and
+        evicts the least recently used blobs first.  Recency is kept in the file mtimes, which are touched on
+        each hit, so the eviction order survives between runs.  Several processes may share a cache directory;
+        files removed by another process are treated as misses.
+
+        Args:
+            path (str): The cache directory, created if needed.
+            maxsize (int): The maximum total size of the cached blobs in bytes.
+            hasher (callable): The content hash function of the archive, see make_hasher().
+        """
+        self.path = os.path.expanduser(path)
+        self.maxsize = maxsize
+        self.hasher = hasher
+        self.lock = threading.Lock()  # guards the LRU list, the size and the counters
+        self.entries = OrderedDict()  # hash -> size, least recently used first
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytes_hit = 0
+        self.evictions = 0
+        os.makedirs(self.path, exist_ok=True)
+        self._load()
+
+    def _file(self, hash : str) -> str:
+        return os.path.join(self.path, hash[0:2], hash)
+
+    def _load(self):
+        """Rebuilds the LRU list from the cache directory, in order of mtime."""
+        found = []
+        for dirpath, _dirs, files in os.walk(self.path):
+            for name in files:
+                path = os.path.join(dirpath, name)
+                st = os.stat(path)
+                if name.endswith(".tmp"):
+                    # left behind by an interrupted put, unless another process is writing it right now
+                    if time.time() - st.st_mtime > 3600:
+                        os.remove(path)
+                    continue
+                found.append((st.st_mtime_ns, name, st.st_size))
+        for _mtime, hash, size in sorted(found):
+            self.entries[hash] = size
+            self.size += size
+        with self.lock:
+            self._evict()
+
+    def _evict(self):
+        """Removes the least recently used blobs until the cache fits.  Called with the lock held."""
+        while self.size > self.maxsize and self.entries:
+            hash, size = self.entries.popitem(last=False)
+            self.size -= size
+            self.evictions += 1
+            try:
+                os.remove(self._file(hash))
+            except FileNotFoundError:
+                pass
+
+    def _discard(self, hash : str):
+        with self.lock:
+            size = self.entries.pop(hash, None)
+            if size is not None:
+                self.size -= size
+            self.misses += 1
+        try:
+            os.remove(self._file(hash))
+        except FileNotFoundError:
+            pass
+
+    def get(self, hash : str) -> bytes:
+        """Returns the cached blob with the given hash, or None on a miss.  Safe to call from worker threads."""
+        with self.lock:
+            present = hash in self.entries
+            if present:
+                self.entries.move_to_end(hash)
+            else:
+                self.misses += 1
+        if not present:
+            return None
+        path = self._file(hash)
+        try:
+            with open(path, "rb") as f:
+                buf = f.read()
+        except FileNotFoundError:
+            self._discard(hash)
+            return None
+        if self.hasher(buf) != hash:
+            self._discard(hash)
+            return None
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        with self.lock:
+            self.hits += 1
+            self.bytes_hit += len(buf)
+        return buf
+
+    def put(self, hash : str, blob : bytes):
+        """Adds a blob read from the object store, evicting older blobs as needed.  Safe to call from worker
+        threads.  Blobs larger than the whole cache are not kept.
+        """
+        if len(blob) > self.maxsize:
+            return
+        path = self._file(hash)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write under a private name and rename, so that readers never see a partial blob
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(blob)
+        os.replace(tmp, path)
+        with self.lock:
+            self.size += len(blob) - self.entries.get(hash, 0)
+            self.entries[hash] = len(blob)
+            self.entries.move_to_end(hash)
+            self._evict()
+
@@ -0,0 +1,238 @@
+from hashlib import md5
+from typing import BinaryIO, Iterator
+import io
+import os
+import threading
+
+def KiB(n): return n*1024
+def MiB(n): return KiB(n)*1024
+def GiB(n): return MiB(n)*1024
+
+
+MAXBLOB=MiB(32)
+
+
+MINBUFFER=KiB(64)
+
+
+class BufferPool:
+    def __init__(self, count : int, size : int):
+        """A fixed number of reusable buffers that chunks are read into, so that reading a file does not allocate
+        a new bytes object for every part.
+
+        Buffers are sized to the part they are acquired for, rounded up to a power of two between MINBUFFER and
+        size, so that small files do not each hold a buffer of the largest part size.  A free buffer of the same
+        size is reused; otherwise a free buffer of another size is dropped and replaced.  At most count buffers
+        exist at once, and acquire() blocks while all of them are in use, so the pool bounds the memory held by
+        parts in flight to count * size bytes, and to much less when the parts are small.
+
+        Args:
+            count (int): The maximum number of buffers.
+            size (int): The size of the largest buffer, at least the largest part the chunker produces.
+        """
+        assert(count > 0)
+        self.size = size
+        self.free = []
+        self.lock = threading.Condition()
+        self.available = count  # buffers that may still be allocated
+
+    def bufsize(self, size : int = None) -> int:
+        """Returns the size of the buffer allocated for a part of size bytes."""
+        if size is None or size >= self.size:
+            return self.size
+        return min(self.size, max(MINBUFFER, 1 << (size - 1).bit_length()))
+
+    def acquire(self, size : int = None) -> bytearray:
+        """Returns a buffer of at least size bytes, or of the pool's size if size is None, blocking while all the
+        buffers are in use.
+        """
+        size = self.bufsize(size)
+        with self.lock:
+            while len(self.free) == 0 and self.available == 0:
+                self.lock.wait()
+            for i, buf in enumerate(self.free):
+                if len(buf) == size:
+                    return self.free.pop(i)
+            if len(self.free) > 0:
+                self.free.pop()
+            else:
+                self.available -= 1
+        return bytearray(size)
+
+    def release(self, buf):
+        """Return a buffer, or a memoryview of one, to the pool.  Views of it must not be used afterwards."""
+        with self.lock:
+            self.free.append(buf.obj if isinstance(buf, memoryview) else buf)
+            self.lock.notify()
+
+
+def file_size(f : BinaryIO) -> int:
+    """Returns the size of an open file, or None if it is not a regular file."""
+    try:
+        return os.fstat(f.fileno()).st_size
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return None
+
+
+def read_full(f : BinaryIO, view : memoryview) -> int:
+    """Reads from f into view until it is full or the end of the file, returning the number of bytes read."""
+    n = 0
+    while n < len(view):
+        k = f.readinto(view[n:])
+        if not k:
+            break
+        n += k
+    return n
+
+
+class FixedChunker:
+    def __init__(self, size : int = MAXBLOB):
+        """Splits files into parts of a fixed size.  Only the last part of a file may be shorter.
+
+        Args:
+            size (int): The size of each part.
+        """
+        assert(0 < size <= MAXBLOB)
+        self.size = size
+
+    @property
+    def maxsize(self) -> int:
+        return self.size
+
+    def chunks(self, f : BinaryIO, pool : BufferPool = None) -> Iterator[memoryview]:
+        """Yields the parts of an open file in order, as views of buffers read with readinto().
+
+        Args:
+            f (BinaryIO): The file to split.
+            pool (BufferPool): The pool the buffers are taken from.  Each yielded view holds a buffer until the
+                caller releases it to the pool.  Without a pool a single buffer is reused, and each view is only
+                valid until the next part is requested.
+        """
+        own = pool is None
+        if own:
+            pool = BufferPool(1, self.size)
+        # buffers are sized to the part expected at each offset, so a small file takes a small buffer
+        remaining = file_size(f)
+        while True:
+            buf = pool.acquire(min(self.size, max(remaining, 1)) if remaining is not None else None)
+            n = read_full(f, memoryview(buf)[:self.size])
+            if remaining is not None:
+                # a file that grows while it is read falls back to full size buffers
+                remaining = remaining - n if remaining >= n else None
+            if n == 0:
+                pool.release(buf)
+                break
+            yield memoryview(buf)[:n]
+            if own:
+                pool.release(buf)
+
+
+# 256 fixed pseudo-random 64 bit values for the gear rolling hash.  These must never change, or chunk
+# boundaries (and therefore deduplication against existing archives) would change with them.
+GEAR = [int.from_bytes(md5(bytes([i])).digest()[:8], 'little') for i in range(256)]
+M64 = (1 << 64) - 1
+
+
+class CdcChunker:
+    def __init__(self, minsize : int = MiB(1), avgsize : int = MiB(4), maxsize : int = MiB(16)):
+        """Splits files into content-defined parts using a gear rolling hash with normalized chunking (FastCDC).
+
+        Part boundaries depend only on the bytes near them, so inserting or deleting data in a file only changes
+        the parts around the edit and the rest of the file still deduplicates.  Parts are between minsize and maxsize
+        bytes long and average about avgsize bytes.
+
+        The rolling hash runs in pure Python and is much slower than fixed size chunking, so content-defined
+        chunking is best reserved for archives of large, slowly changing files such as VM images and mailboxes.
+        Besides the parts being stored, the chunker holds a read window of 2 * maxsize bytes.  The window is
+        allocated once and reused for every file; a file split while another is still being split gets a window
+        of its own.
+
+        Args:
+            minsize (int): The minimum part size.  The first minsize bytes of each part are not hashed.
+            avgsize (int): The target average part size; must be a power of two.
+            maxsize (int): The maximum part size, at most MAXBLOB.
+        """
+        assert(0 < minsize < avgsize < maxsize <= MAXBLOB)
+        assert(avgsize & (avgsize - 1) == 0)
+        self.minsize = minsize
+        self.avgsize = avgsize
+        self.maxsize = maxsize
+        bits = avgsize.bit_length() - 1
+        # a stricter mask before the average size and a looser one after it narrows the size distribution
+        self.mask_s = ((1 << (bits + 1)) - 1) << (64 - bits - 1)
+        self.mask_l = ((1 << (bits - 1)) - 1) << (64 - bits + 1)
+        self.window = None  # the read window, kept between files
+        self.lock = threading.Lock()
+
+    def cut_point(self, data, n : int) -> int:
+        """Returns the length of the next part of data, given n bytes available (all of the rest of the file, or
+        at least maxsize bytes).
+        """
+        if n <= self.minsize:
+            return n
+        end = min(n, self.maxsize)
+        normal = min(end, self.avgsize)
+        gear = GEAR
+        fp = 0
+        i = self.minsize
+        mask = self.mask_s
+        while i < normal:
+            fp = ((fp << 1) + gear[data[i]]) & M64
+            i += 1
+            if not fp & mask:
+                return i
+        mask = self.mask_l
+        while i < end:
+            fp = ((fp << 1) + gear[data[i]]) & M64
+            i += 1
+            if not fp & mask:
+                return i
+        return end
+
+    def chunks(self, f : BinaryIO, pool : BufferPool = None) -> Iterator[memoryview]:
+        """Yields the parts of an open file in order, as views of buffers taken from the pool.  See
+        FixedChunker.chunks().
+        """
+        own = pool is None
+        if own:
+            pool = BufferPool(1, self.maxsize)
+        with self.lock:
+            window, self.window = self.window, None
+        if window is None:
+            window = bytearray(2 * self.maxsize)
+        view = memoryview(window)
+        try:
+            start = end = 0
+            eof = False
+            while True:
+                if not eof and end - start < self.maxsize:
+                    if end == len(window):
+                        # less than maxsize bytes remain past start >= maxsize, so the move never overlaps
+                        window[:end-start] = view[start:end]
+                        start, end = 0, end - start
+                    n = read_full(f, view[end:])
+                    eof = n == 0
+                    end += n
+                    continue
+                if start == end:
+                    break
+                n = self.cut_point(view[start:end], end - start)
+                buf = pool.acquire(n)
+                buf[:n] = view[start:start+n]
+                start += n
+                yield memoryview(buf)[:n]
+                if own:
+                    pool.release(buf)
+        finally:
+            view.release()
+            with self.lock:
+                self.window = window
+
+
+def make_chunker(config):
+    """Returns the chunker selected by the 'chunking' setting of an ArchiveConfig."""
+    if config.chunking == "cdc":
+        return CdcChunker(config.chunkmin, config.chunkavg, config.chunkmax)
+    if config.chunking == "fixed":
+        return FixedChunker()
+    raise ValueError(f"Unknown chunking mode '{config.chunking}'")
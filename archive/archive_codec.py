@@ -0,0 +1,94 @@
+import math
+import lzma
+import zlib
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Stored blobs that start with MAGIC are followed by a codec byte and the encoded data.  Anything else is the
+# raw blob, as written before compression was supported.
+MAGIC = b"ARC\x1aZ"
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_LZMA = 2
+CODEC_ZSTD = 3
+CODECS = { "none": CODEC_NONE, "zlib": CODEC_ZLIB, "lzma": CODEC_LZMA, "zstd": CODEC_ZSTD }
+
+SAMPLE_SIZE = 4096
+SAMPLE_COUNT = 8
+
+
+class ArchiveCodec:
+    def __init__(self, compression : str = "none", level : int = None, max_entropy : float = 7.5):
+        """Compresses blobs before they are stored and decompresses them when they are read.
+
+        The blob hash is always computed over the uncompressed data, so compression does not affect deduplication.
+        Blobs that look incompressible (already compressed media, archives, encrypted data) are stored as they are.
+
+        Args:
+            compression (str): 'none', 'zlib', 'lzma' or 'zstd' (requires the zstandard package).
+            level (int): The compression level, or None for the codec's default.
+            max_entropy (float): Blobs whose sampled byte entropy exceeds this many bits per byte are not compressed.
+        """
+        if compression not in CODECS:
+            raise ValueError(f"Unknown compression '{compression}'")
+        if compression == "zstd" and zstandard is None:
+            raise ValueError("Compression 'zstd' requires the zstandard package")
+        self.codec = CODECS[compression]
+        self.level = level
+        self.max_entropy = max_entropy
+
+    @classmethod
+    def entropy(cls, blob : bytes) -> float:
+        """Estimates the byte entropy of a blob in bits per byte from a few samples spread across it."""
+        if len(blob) <= SAMPLE_SIZE * SAMPLE_COUNT:
+            sample = bytes(blob)
+        else:
+            step = (len(blob) - SAMPLE_SIZE) // (SAMPLE_COUNT - 1)
+            sample = b"".join(blob[i*step:i*step+SAMPLE_SIZE] for i in range(SAMPLE_COUNT))
+        if len(sample) == 0:
+            return 0.0
+        n = len(sample)
+        return -sum(c/n * math.log2(c/n) for c in (sample.count(bytes([b])) for b in range(256)) if c > 0)
+
+    def compress(self, blob : bytes) -> bytes:
+        if self.codec == CODEC_ZLIB:
+            return zlib.compress(blob, self.level if self.level is not None else 6)
+        if self.codec == CODEC_LZMA:
+            return lzma.compress(blob, preset=self.level)
+        if self.codec == CODEC_ZSTD:
+            return zstandard.ZstdCompressor(level=self.level if self.level is not None else 3).compress(blob)
+        return blob
+
+    @classmethod
+    def decompress(cls, codec : int, data : bytes) -> bytes:
+        if codec == CODEC_NONE:
+            return data
+        if codec == CODEC_ZLIB:
+            return zlib.decompress(data)
+        if codec == CODEC_LZMA:
+            return lzma.decompress(data)
+        if codec == CODEC_ZSTD:
+            if zstandard is None:
+                raise ValueError("Blob is compressed with zstd, which requires the zstandard package")
+            return zstandard.ZstdDecompressor().decompress(data)
+        raise ValueError(f"Unknown blob codec {codec}")
+
+    def encode(self, blob : bytes) -> bytes:
+        """Returns the data to store for a blob: compressed with a header if that saves space, otherwise the blob."""
+        if self.codec != CODEC_NONE and len(blob) > 0 and self.entropy(blob) <= self.max_entropy:
+            data = self.compress(blob)
+            if len(data) + len(MAGIC) + 1 < len(blob):
+                return MAGIC + bytes([self.codec]) + data
+        if blob[:len(MAGIC)] == MAGIC:
+            # a raw blob that happens to start with the magic needs a header to be read back correctly
+            return MAGIC + bytes([CODEC_NONE]) + blob
+        return blob
+
+    @classmethod
+    def decode(cls, data : bytes) -> bytes:
+        """Returns the blob stored as data by encode()."""
+        if data[:len(MAGIC)] != MAGIC:
+            return data
+        return cls.decompress(data[len(MAGIC)], data[len(MAGIC)+1:])
@@ -3,14 +3,31 @@ import yaml
 CONFIG_PATH="config.yaml"
 
 class ArchiveConfig:
-    def __init__(self, name, debug=False):
+    def __init__(self, name, debug=False, path=CONFIG_PATH, settings=None):
+        """Initialize the configuration of an archive.
+
+        Args:
+            name (str): The name of the archive, a key under 'archive' in the configuration file.
+            debug (bool): If True, print debugging output, including every SQL statement.
+            path (str): The configuration file.
+            settings (dict): The settings of the archive, used instead of reading the configuration file.
+        """
         if debug:
             print("ArchiveConfig:", name)
         self.debug = debug
         self.archive_name = name
         self.hostname = socket.gethostname()
-        with open(CONFIG_PATH, "rt") as f:
-            self.config = yaml.load(f, yaml.loader.SafeLoader)['archive'][name]
+        if settings is not None:
+            self.config = settings
+        else:
+            with open(path, "rt") as f:
+                self.config = yaml.load(f, yaml.loader.SafeLoader)['archive'][name]
+
+    @classmethod
+    def archive_names(cls, path=CONFIG_PATH) -> list:
+        """Returns the names of the archives defined in a configuration file."""
+        with open(path, "rt") as f:
+            return list(yaml.load(f, yaml.loader.SafeLoader)['archive'].keys())
 
     @property
     def database(self):
@@ -20,6 +37,114 @@ class ArchiveConfig:
     def verifyreads(self):
         return self.config['verifyreads']
 
+    @property
+    def gcgrace(self):
+        return self.config.get('gcgrace', 86400)
+
+    @property
+    def leaseexpire(self):
+        return self.config.get('leaseexpire', 3600)
+
+    @property
+    def keepgenerations(self):
+        return self.config.get('keepgenerations', 30)
+
+    @property
+    def scrubrate(self):
+        return self.config.get('scrubrate', 0)
+
+    @property
+    def exclude(self):
+        return self.config.get('exclude', ['.*'])
+
+    @property
+    def cachedir(self):
+        return self.config.get('cachedir', None)
+
+    @property
+    def cachesize(self):
+        return self.config.get('cachesize', 1024*1024*1024)
+
+    @property
+    def probebackend(self):
+        return self.config.get('probebackend', False)
+
+    @property
+    def connections(self):
+        return self.config.get('connections', 8)
+
+    @property
+    def retries(self):
+        return self.config.get('retries', 5)
+
+    @property
+    def retrydelay(self):
+        return self.config.get('retrydelay', 0.5)
+
+    @property
+    def workers(self):
+        return self.config.get('workers', 4)
+
+    @property
+    def maxbuffers(self):
+        return self.config.get('maxbuffers', 8)
+
+    @property
+    def batchentries(self):
+        return self.config.get('batchentries', 1000)
+
+    @property
+    def batchseconds(self):
+        return self.config.get('batchseconds', 5.0)
+
+    @property
+    def lazyindex(self):
+        return self.config.get('lazyindex', False)
+
+    @property
+    def pathsearch(self):
+        return self.config.get('pathsearch', False)
+
+    @property
+    def chunking(self):
+        return self.config.get('chunking', 'fixed')
+
+    @property
+    def chunkmin(self):
+        return self.config.get('chunkmin', 1024*1024)
+
+    @property
+    def chunkavg(self):
+        return self.config.get('chunkavg', 4*1024*1024)
+
+    @property
+    def chunkmax(self):
+        return self.config.get('chunkmax', 16*1024*1024)
+
+    @property
+    def packing(self):
+        return self.config.get('packing', False)
+
+    @property
+    def packthreshold(self):
+        return self.config.get('packthreshold', 1024*1024)
+
+    @property
+    def packsize(self):
+        return self.config.get('packsize', 16*1024*1024)
+
+    @property
+    def compression(self):
+        return self.config.get('compression', 'none')
+
+    @property
+    def compressionlevel(self):
+        return self.config.get('compressionlevel', None)
+
+    @property
+    def hashalg(self):
+        return self.config.get('hash', 'md5')
+
     @property
     def localmirror(self):
         return self.config['mirrors'][self.hostname]
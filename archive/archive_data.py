@@ -1,8 +1,35 @@
+import base64
 import json
 import sqlite3
 import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import List
 from .archive_config import ArchiveConfig
 from .archive_entry import ArchiveEntry
+from .archive_pattern import ArchivePattern
+from .archive_metrics import ArchiveMetrics
+
+def hash2blob(hash : str) -> bytes:
+    """Convert a hex hash string to the binary form stored in EntryHashes."""
+    return base64.b16decode(hash)
+
+def blob2hash(blob : bytes) -> str:
+    """Convert a binary hash stored in EntryHashes to a hex hash string."""
+    return base64.b16encode(blob).decode('ASCII')
+
+def libdir(libpath : str) -> str:
+    """Returns the library path of the directory containing libpath; '' for the root directory."""
+    return libpath[:libpath.rfind('/')] if '/' in libpath else ''
+
+def prefix_range(prefix : str):
+    """Returns the (low, high) bounds of the strings starting with prefix, for use as 'x >= low AND x < high'
+    in an indexed range query.  high is None if prefix is empty.
+    """
+    if len(prefix) == 0:
+        return "", None
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
 
 class BucketedHashTable:
     def __init__(self):
@@ -28,8 +55,96 @@ class BucketedHashTable:
     def __getitem__(self, key):
         return self.data[key]
 
+class ArchiveDataWriter:
+    def __init__(self, data, batch_entries : int = 1000, batch_seconds : float = 5.0, before_commit = None,
+                 generation : int = None):
+        """Initialize a batched entry writer.
+
+        Entries are written inside an open transaction that is committed every batch_entries entries or
+        batch_seconds seconds, whichever comes first, and when the writer is closed.  Each entry is written
+        completely or not at all, so an interrupted backup leaves the index consistent as of the last commit.
+        Use as a context manager; leaving the block because of an exception commits the entries written so far.
+
+        Args:
+            data (ArchiveData): The database to write to.
+            batch_entries (int): The maximum number of entries per transaction.
+            batch_seconds (float): The maximum age of a transaction in seconds.
+            before_commit (callable): Called inside the transaction just before each commit, to write rows that
+                must be committed together with the entries.
+            generation (int): The generation the entries are written to, see ArchiveData.write_entry().
+        """
+        self.data = data
+        self.before_commit = before_commit
+        self.generation = generation
+        self.batch_entries = batch_entries
+        self.batch_seconds = batch_seconds
+        self.pending = 0
+        self.started = None
+        self.entries_written = 0
+        self.commits = 0
+        self.elapsed = 0.0  # seconds spent in SQLite
+
+    def write_entry(self, entry : ArchiveEntry) -> ArchiveEntry:
+        """Write an entry in the current batch, committing the batch if it is full or old enough."""
+        t0 = time.monotonic()
+        if self.started is None:
+            self.data.sql("BEGIN")
+            self.started = t0
+        self.data.sql("SAVEPOINT entry")
+        try:
+            self.data.write_entry(entry, self.generation)
+        except BaseException:
+            self.data.sql("ROLLBACK TO entry")
+            raise
+        finally:
+            self.data.sql("RELEASE entry")
+        self.pending += 1
+        self.entries_written += 1
+        self.elapsed += time.monotonic() - t0
+        self.data.metrics.observe('write_entry', time.monotonic() - t0)
+        if self.pending >= self.batch_entries or time.monotonic() - self.started >= self.batch_seconds:
+            self.commit()
+        return entry
+
+    def commit(self):
+        """Commit the entries written since the last commit."""
+        if self.started is not None:
+            if self.before_commit is not None:
+                self.before_commit()
+            t0 = time.monotonic()
+            self.data.sql("COMMIT")
+            self.elapsed += time.monotonic() - t0
+            self.commits += 1
+            self.pending = 0
+            self.started = None
+
+    def checkpoint(self):
+        """Commit once the batch is batch_seconds old, even if no entry has been written, so that the rows written
+        by before_commit become durable while a large file is being stored.
+        """
+        now = time.monotonic()
+        if self.started is None:
+            self.data.sql("BEGIN")
+            self.started = now
+        elif now - self.started >= self.batch_seconds:
+            self.commit()
+
+    def close(self):
+        self.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    @property
+    def entries_per_second(self):
+        return self.entries_written / self.elapsed if self.elapsed > 0 else 0.0
+
+
 class ArchiveData:
-    def __init__(self, config : ArchiveConfig):
+    def __init__(self, config : ArchiveConfig, metrics : ArchiveMetrics = None):
         """Initialize ArchiveData Database with the given configuration.
 
         This method sets up the SQLite database connection and initializes the schema if it does not exist.
@@ -37,8 +152,11 @@ class ArchiveData:
 
         Args:
             config (ArchiveConfig): The configuration object for the archive.
+            metrics (ArchiveMetrics): Where the time spent in SQLite is recorded, as the 'sqlite' latency.
         """
         self.config = config
+        self.metrics = metrics if metrics is not None else ArchiveMetrics()
+        self.lock = threading.RLock()  # the connection is shared with backup and restore worker threads
         self.dbinit()
 
     def close(self):
@@ -54,21 +172,84 @@ class ArchiveData:
                 column names to values; otherwise, returns last row ID.
         """
         result = None
-        cur = self.con.cursor()
-        if self.config.debug:
-            print("ArchiveData:", "sql()", _sql, args)
-        cur.execute(_sql, args)
-        if read:
-            data = cur.fetchall()
-            desc = cur.description
-            result = [{
-                desc[i][0]: data[j][i] for i in range( len(desc))
-            } for j in range(len(data))]
-        else:
-            result = cur.lastrowid
-        cur.close()
+        with self.lock:
+            cur = self.con.cursor()
+            if self.config.debug:
+                print("ArchiveData:", "sql()", _sql, args)
+            t0 = time.perf_counter()
+            cur.execute(_sql, args)
+            if read:
+                data = cur.fetchall()
+                desc = cur.description
+                result = [{
+                    desc[i][0]: data[j][i] for i in range( len(desc))
+                } for j in range(len(data))]
+            else:
+                result = cur.lastrowid
+            cur.close()
+            self.metrics.observe('sqlite', time.perf_counter() - t0)
         return result
 
+    def cursor(self, _sql, *args, batch=1000):
+        """Runs a SELECT statement and yields the results one row at a time as dictionaries.  Rows are fetched
+        in batches, so memory use does not depend on the size of the result.
+        Args:
+            _sql (str): The SELECT statement to execute, with '?' placeholders for parameters.
+            *args: Parameters to bind to the SQL statement.
+            batch (int): The number of rows to fetch at a time.
+        """
+        with self.lock:
+            cur = self.con.cursor()
+            if self.config.debug:
+                print("ArchiveData:", "cursor()", _sql, args)
+            t0 = time.perf_counter()
+            cur.execute(_sql, args)
+            cols = [d[0] for d in cur.description]
+            self.metrics.observe('sqlite', time.perf_counter() - t0)
+        try:
+            while True:
+                with self.lock:
+                    t0 = time.perf_counter()
+                    rows = cur.fetchmany(batch)
+                    self.metrics.observe('sqlite', time.perf_counter() - t0)
+                if len(rows) == 0:
+                    break
+                for row in rows:
+                    yield dict(zip(cols, row))
+        finally:
+            cur.close()
+
+    def sqlmany(self, _sql, rows):
+        """Execute a SQL command once for each row of parameters.
+        Args:
+            _sql (str): The SQL command to execute, with '?' placeholders for parameters.
+            rows (Iterable[tuple]): One tuple of parameters per execution.
+        """
+        with self.lock:
+            cur = self.con.cursor()
+            if self.config.debug:
+                print("ArchiveData:", "sqlmany()", _sql)
+            t0 = time.perf_counter()
+            cur.executemany(_sql, rows)
+            cur.close()
+            self.metrics.observe('sqlite', time.perf_counter() - t0)
+
+    @contextmanager
+    def transaction(self):
+        """Run the enclosed statements in a single transaction, rolling back if an exception is raised.
+        If a transaction is already open, the statements join it instead.
+        """
+        if self.con.in_transaction:
+            yield
+            return
+        self.sql("BEGIN")
+        try:
+            yield
+        except BaseException:
+            self.sql("ROLLBACK")
+            raise
+        self.sql("COMMIT")
+
     def select(self, _sql, *args):
         """Runs a SELECT statement and returns the results as a list of dictionaries."""
         return self.sql(_sql, *args, read=True)
@@ -119,9 +300,8 @@ class ArchiveData:
         Args:
             ver (int): The new schema version to set.
         """
-        sver = str(ver)
         cur = self.con.cursor()
-        cur.execute("UPDATE SchemaVersion SET version=?", sver)
+        cur.execute("UPDATE SchemaVersion SET version=?", (ver,))
         cur.close()
 
     def dbupgrade(self, newver:int):
@@ -132,10 +312,11 @@ class ArchiveData:
         """
         script = self.schema[newver]
         statements = script.strip().split(";")
-        for statement in statements:
-            self.sql(statement)
-        #self.sqlscript(script)
-        self.schemaversion = newver
+        with self.transaction():
+            for statement in statements:
+                self.sql(statement)
+            #self.sqlscript(script)
+            self.schemaversion = newver
 
     def dbinit(self):
         """Initialize the database schema.  The database is created if it does not exist, and the schema is upgraded to the target version.
@@ -150,54 +331,109 @@ class ArchiveData:
                 raise ValueError("Bad directory specified for database")
 
         # initialize database
-        self.con = sqlite3.connect(self.config.database, autocommit=True)
+        self.con = sqlite3.connect(self.config.database, autocommit=True, check_same_thread=False)
+        # WAL lets a batch commit without rewriting the main database file; with synchronous=NORMAL a
+        # crash may lose the last batches but always leaves a consistent index.
+        self.sql("PRAGMA journal_mode=WAL")
+        self.sql("PRAGMA synchronous=NORMAL")
+        # used by the v3 upgrade to convert hex hashes in place
+        self.con.create_function("hash2blob", 1, lambda h: hash2blob(h) if isinstance(h, str) else h, deterministic=True)
+        self.con.create_function("libdir", 1, libdir, deterministic=True)
         current_ver = self.schemaversion
         if self.config.debug:
             print("Current schema:",current_ver)
             print("Target schema", self.schema_target_ver)
         for v in range(self.schemaversion, self.schema_target_ver):
             self.dbupgrade(v+1)
+        self.has_path_search = self.select1("SELECT 1 FROM sqlite_master WHERE name = 'ArchivePathSearch'") is not None
+        if self.config.pathsearch and not self.has_path_search:
+            self.create_path_search()
+
+    def create_path_search(self):
+        """Create the optional trigram index of library paths used to find entries by infix patterns such as
+        '*vacation*'.  The index is kept up to date by triggers on ArchiveEntry.  Requires SQLite 3.34 or later
+        with FTS5.
+        """
+        self.sqlscript(self.path_search_schema)
+        self.has_path_search = True
 
-    def write_archive(self, name):
+    def write_archive(self, name, hashalg="md5"):
         """Write a new archive with the given name to the database.
         Args:
             name (str): The name of the archive to create.
+            hashalg (str): The content hash algorithm used for the blobs of the archive.
         """
-        archive_id = self.sql("INSERT INTO Archive(name) VALUES (?)", name)
+        archive_id = self.sql("INSERT INTO Archive(name, hashalg) VALUES (?, ?)", name, hashalg)
         return archive_id
 
+    def read_hashalg(self, archive_id : int) -> str:
+        """Returns the content hash algorithm of an archive."""
+        return self.select1("SELECT hashalg FROM Archive WHERE id = ?", archive_id, require=True)
+
     def del_entry(self, entry_id : int):
         """Delete an entry (an archived file) from the ArchiveEntry and EntryHashes tables by its ID.
         Args:
             entry_id (int): The ID of the entry to delete.
         """
-        # todo: combine these into a single transaction
-        self.sql("DELETE FROM ArchiveEntry WHERE id = ?", entry_id)
-        self.sql("DELETE FROM EntryHashes WHERE archive_entry_id = ?", entry_id)
+        with self.transaction():
+            self.sql("DELETE FROM ArchiveEntry WHERE id = ?", entry_id)
+            self.sql("DELETE FROM EntryHashes WHERE archive_entry_id = ?", entry_id)
+
+    def write_entry(self, entry : ArchiveEntry, generation : int = None):
+        """Upsert an entry (an archived file) to the database.  The entry row and its hashes are written in one
+        transaction, or as part of the caller's transaction if one is open.
 
-    def write_entry(self, entry : ArchiveEntry):
-        """Upsert an entry (an archived file) to the database.
+        When a generation is given, an existing entry row that belongs to an earlier generation is kept for
+        that generation's snapshot: it is closed at this generation and the entry is written as a new row.
+        If the contents are unchanged, only the stat cache of the existing row is updated.
 
         Args:
             entry (ArchiveEntry): The entry to write.
+            generation (int): The generation being written.
 
         Returns:
             ArchiveEntry: The written entry, including its ID.
         """
-        #self.del_entry()
-        if entry.id >= 0:
-            self.sql("UPDATE ArchiveEntry(archive_id, libpath, size) VALUES (?, ?, ?) WHERE id = ?",
-                     entry.archive_id, entry.libpath, entry.size, entry.id)
-        else:
-            entry.id = self.sql("INSERT INTO ArchiveEntry(archive_id, libpath, size) VALUES (?,?,?)",
-                                entry.archive_id, entry.libpath, entry.size)
-        #print("entry=",entry_id)
-        for i,h in enumerate(entry.hashlist):
-            #print(h)
-            self.sql("INSERT INTO EntryHashes(archive_id, archive_entry_id, seq, hash) VALUES (?,?,?,?)",
-                     entry.archive_id, entry.id, i, h)
+        with self.transaction():
+            if entry.id >= 0 and generation is not None:
+                prev = self.select("SELECT size, gen_from FROM ArchiveEntry WHERE id = ?", entry.id)[0]
+                if prev['gen_from'] != generation and prev['size'] == entry.size and self.read_hashes(entry.id) == entry.hashlist:
+                    self.sql("UPDATE ArchiveEntry SET mtime_ns = ?, ctime_ns = ?, inode = ? WHERE id = ?",
+                             entry.mtime_ns, entry.ctime_ns, entry.inode, entry.id)
+                    return entry
+                if prev['gen_from'] != generation:
+                    self.sql("UPDATE ArchiveEntry SET gen_to = ? WHERE id = ?", generation, entry.id)
+                    entry.id = ArchiveEntry.next_seq_id()
+            if entry.id >= 0:
+                self.sql("UPDATE ArchiveEntry SET archive_id = ?, libpath = ?, dirname = ?, size = ?, mtime_ns = ?, ctime_ns = ?, inode = ? WHERE id = ?",
+                         entry.archive_id, entry.libpath, libdir(entry.libpath), entry.size, entry.mtime_ns, entry.ctime_ns, entry.inode, entry.id)
+                self.sql("DELETE FROM EntryHashes WHERE archive_entry_id = ?", entry.id)
+            else:
+                entry.id = self.sql("INSERT INTO ArchiveEntry(archive_id, libpath, dirname, size, mtime_ns, ctime_ns, inode, gen_from) VALUES (?,?,?,?,?,?,?,?)",
+                                    entry.archive_id, entry.libpath, libdir(entry.libpath), entry.size, entry.mtime_ns, entry.ctime_ns, entry.inode, generation)
+            self.sqlmany("INSERT INTO EntryHashes(archive_id, archive_entry_id, seq, hash, size) VALUES (?,?,?,?,?)",
+                         [(entry.archive_id, entry.id, i, hash2blob(h), entry.partsizes[i]) for i,h in enumerate(entry.hashlist)])
         return entry
 
+    def writer(self, batch_entries : int = 1000, batch_seconds : float = 5.0, before_commit = None, generation : int = None):
+        """Returns an ArchiveDataWriter that writes entries to this database in batched transactions."""
+        return ArchiveDataWriter(self, batch_entries, batch_seconds, before_commit, generation)
+
+    def write_packed(self, located : list):
+        """Record the locations of packed blobs.
+        Args:
+            located (list): (hash, pack, offset, length) tuples, as returned by ArchiveObject.flush_packs().
+        """
+        self.sqlmany("INSERT OR IGNORE INTO PackedBlobs(hash, pack, offset, length) VALUES (?,?,?,?)",
+                     [(hash2blob(h), hash2blob(pack), offset, length) for h, pack, offset, length in located])
+
+    def read_packed(self, hash : str) -> tuple:
+        """Returns the (pack, offset, length) location of a packed blob, or None if the blob is not in a pack."""
+        rows = self.select("SELECT pack, offset, length FROM PackedBlobs WHERE hash = ?", hash2blob(hash))
+        if len(rows) == 0:
+            return None
+        return blob2hash(rows[0]['pack']), rows[0]['offset'], rows[0]['length']
+
     def read_entries(self, archive_name):
         """Read entries from the archive with the given name.
         This method retrieves the archive ID, entry hashes, and index of entries for the specified archive name.
@@ -206,33 +442,454 @@ class ArchiveData:
             archive_name (str): The name of the archive to read entries from.
 
         Returns:
-            tuple(archive_id, ihashes, index): A tuple containing the archive ID, a BucketedHashTable of entry hashes, and an index of entries.
-                   If the archive does not exist, returns None.
+            tuple(archive_id, ihashes, index, isizes): A tuple containing the archive ID, a BucketedHashTable of entry hashes, an index of
+                   entries, and a BucketedHashTable of part sizes parallel to the hashes.  If the archive does not exist, returns None.
         """
         archive_id = self.select1("SELECT id FROM Archive WHERE name = ?", archive_name)
         if archive_id is None:
             return None
 
-        entries = self.select("SELECT id, libpath, size FROM ArchiveEntry WHERE archive_id = ?", archive_id)
-        hashes = self.select("SELECT archive_entry_id, seq, hash FROM EntryHashes WHERE archive_id = ? ORDER BY archive_entry_id, seq",
+        entries = self.select("SELECT id, libpath, size, mtime_ns, ctime_ns, inode FROM ArchiveEntry WHERE archive_id = ? AND gen_to IS NULL", archive_id)
+        hashes = self.select("SELECT archive_entry_id, seq, hash, size FROM EntryHashes WHERE archive_id = ? ORDER BY archive_entry_id, seq",
                              archive_id)
         ihashes=BucketedHashTable()
+        isizes=BucketedHashTable()
         for row in hashes:
             eid = row['archive_entry_id']
-            ihashes.add_item(eid, row['hash'])
+            ihashes.add_item(eid, blob2hash(row['hash']))
+            isizes.add_item(eid, row['size'])
             assert(len(ihashes.data[eid])==row['seq']+1)
         index = {}
         for row in entries:
             eid = row['id']
             index[eid] = row
         #print(f"read_entries: {archive_name}({archive_id}) ->", len(index), "entries")
-        return archive_id, ihashes, index
+        return archive_id, ihashes, index, isizes
+
+    def read_archive_id(self, archive_name):
+        """Returns the ID of the archive with the given name, or None if it does not exist."""
+        return self.select1("SELECT id FROM Archive WHERE name = ?", archive_name)
+
+    def read_entry(self, archive_id : int, libpath : str):
+        """Returns the entry row for a library path, or None if the archive has no such entry."""
+        rows = self.select("SELECT id, libpath, size, mtime_ns, ctime_ns, inode FROM ArchiveEntry WHERE archive_id = ? AND gen_to IS NULL AND libpath = ?",
+                           archive_id, libpath)
+        return rows[0] if len(rows) > 0 else None
+
+    def read_hashes(self, entry_id : int) -> List[str]:
+        """Returns the hash list of an entry, in part order."""
+        rows = self.select("SELECT hash FROM EntryHashes WHERE archive_entry_id = ? ORDER BY seq", entry_id)
+        return [blob2hash(row['hash']) for row in rows]
+
+    def read_partsizes(self, entry_id : int) -> List[int]:
+        """Returns the part sizes of an entry, in part order.  Parts stored before sizes were recorded have size None."""
+        rows = self.select("SELECT size FROM EntryHashes WHERE archive_entry_id = ? ORDER BY seq", entry_id)
+        return [row['size'] for row in rows]
+
+    def has_hash(self, archive_id : int, hash : str) -> bool:
+        """Returns True if any entry of the archive references the given hash."""
+        return self.select1("SELECT 1 FROM EntryHashes WHERE hash = ? AND archive_id = ? LIMIT 1",
+                            hash2blob(hash), archive_id) is not None
+
+    def has_stored(self, hash : str) -> bool:
+        """Returns True if a blob is recorded as stored in the object store, on its own or in a pack."""
+        return self.select1("""SELECT EXISTS (SELECT 1 FROM Blobs WHERE hash = ?)
+                OR EXISTS (SELECT 1 FROM PackedBlobs WHERE hash = ?)""", hash2blob(hash), hash2blob(hash)) == 1
+
+    def read_stored_hashes(self) -> List[str]:
+        """Returns the hashes of all blobs recorded as stored in the object store, on their own or in packs."""
+        rows = self.select("SELECT hash FROM Blobs UNION SELECT hash FROM PackedBlobs")
+        return [blob2hash(row['hash']) for row in rows]
+
+    def write_stored(self, stored : list):
+        """Record objects uploaded to the object store.  An object uploaded again is no longer a garbage candidate.
+        Args:
+            stored (list): (hash, size) tuples, as returned by ArchiveObject.take_uploaded().
+        """
+        now = int(time.time())
+        self.sqlmany("""INSERT INTO Blobs(hash, size, stored) VALUES (?,?,?)
+                ON CONFLICT(hash) DO UPDATE SET size = excluded.size, stored = excluded.stored, unreferenced = NULL""",
+                     [(hash2blob(h), size, now) for h, size in stored])
+
+    def mark_orphans(self, now : int) -> int:
+        """Mark the objects that no entry references with the time they were first seen unreferenced, and clear the
+        mark of objects that are referenced again.
+
+        Returns:
+            int: The number of objects newly marked.
+        """
+        with self.transaction():
+            self.sql(f"UPDATE Blobs AS b SET unreferenced = NULL WHERE unreferenced IS NOT NULL AND NOT ({self.orphan_sql})")
+            self.sql(f"UPDATE Blobs AS b SET unreferenced = ? WHERE unreferenced IS NULL AND {self.orphan_sql}", now)
+            return self.select1("SELECT changes()")
+
+    def read_orphans(self, before : int) -> List[dict]:
+        """Returns the ('hash', 'size') rows of the objects that were stored and marked unreferenced no later than
+        before and are still unreferenced.
+        """
+        rows = self.select(f"SELECT hash, size FROM Blobs b WHERE unreferenced <= ? AND stored <= ? AND {self.orphan_sql}",
+                           before, before)
+        return [{ 'hash': blob2hash(row['hash']), 'size': row['size'] } for row in rows]
+
+    def count_orphans(self) -> tuple:
+        """Returns the number of objects marked unreferenced and the number of bytes in packs that no entry references."""
+        marked = self.select1("SELECT COUNT(*) FROM Blobs WHERE unreferenced IS NOT NULL")
+        packed = self.select1("""SELECT COALESCE(SUM(length), 0) FROM PackedBlobs p
+                WHERE NOT EXISTS (SELECT 1 FROM EntryHashes h WHERE h.hash = p.hash)""")
+        return marked, packed
+
+    def del_blobs(self, hashes : List[str]):
+        """Forget objects deleted from the object store, including the locations of the blobs in deleted packs."""
+        rows = [(hash2blob(h),) for h in hashes]
+        with self.transaction():
+            self.sqlmany("DELETE FROM ScrubStatus WHERE hash IN (SELECT hash FROM PackedBlobs WHERE pack = ?)", rows)
+            self.sqlmany("DELETE FROM PackedBlobs WHERE pack = ?", rows)
+            self.sqlmany("DELETE FROM ScrubStatus WHERE hash = ?", rows)
+            self.sqlmany("DELETE FROM Blobs WHERE hash = ?", rows)
+
+    def acquire_lease(self, kind : str, conflicts : tuple, expire : int) -> int:
+        """Register a running backup or garbage collection, unless a conflicting one is running.
+
+        Leases whose heartbeat is older than expire seconds are left by interrupted runs and are removed.
+
+        Args:
+            kind (str): 'backup' or 'gc'.
+            conflicts (tuple): The kinds of lease that may not be held at the same time.
+            expire (int): The age in seconds after which a lease without a heartbeat is stale.
+
+        Returns:
+            int: The lease id, or None if a conflicting lease is held.
+        """
+        now = int(time.time())
+        with self.lock:
+            self.sql("BEGIN IMMEDIATE")
+            try:
+                self.sql("DELETE FROM ArchiveLease WHERE heartbeat < ?", now - expire)
+                marks = ",".join("?" * len(conflicts))
+                if self.select1(f"SELECT COUNT(*) FROM ArchiveLease WHERE kind IN ({marks})", *conflicts) > 0:
+                    self.sql("ROLLBACK")
+                    return None
+                lease = self.sql("INSERT INTO ArchiveLease(kind, started, heartbeat) VALUES (?,?,?)", kind, now, now)
+            except BaseException:
+                self.sql("ROLLBACK")
+                raise
+            self.sql("COMMIT")
+        return lease
+
+    def renew_lease(self, lease : int):
+        self.sql("UPDATE ArchiveLease SET heartbeat = ? WHERE id = ?", int(time.time()), lease)
+
+    def release_lease(self, lease : int):
+        self.sql("DELETE FROM ArchiveLease WHERE id = ?", lease)
+
+    def count_hashes(self, archive_id : int) -> int:
+        """Returns the number of distinct blobs referenced by the entries of an archive."""
+        return self.select1("SELECT COUNT(DISTINCT hash) FROM EntryHashes WHERE archive_id = ?", archive_id)
+
+    def read_scrub_queue(self, archive_id : int, limit : int) -> List[str]:
+        """Returns up to limit distinct hashes of an archive, those never scrubbed first and then those scrubbed
+        longest ago.
+        """
+        rows = self.select("""SELECT h.hash FROM (SELECT DISTINCT hash FROM EntryHashes WHERE archive_id = ?) h
+                LEFT JOIN ScrubStatus s ON s.hash = h.hash ORDER BY s.scrubbed IS NOT NULL, s.scrubbed LIMIT ?""",
+                           archive_id, limit)
+        return [blob2hash(row['hash']) for row in rows]
+
+    def write_scrub_status(self, results : list):
+        """Record scrub results.
+        Args:
+            results (list): (hash, time scrubbed, ok) tuples.
+        """
+        self.sqlmany("INSERT OR REPLACE INTO ScrubStatus(hash, scrubbed, ok) VALUES (?,?,?)",
+                     [(hash2blob(h), scrubbed, int(ok)) for h, scrubbed, ok in results])
 
+    def read_hash_libpaths(self, archive_id : int, hash : str) -> List[str]:
+        """Returns the library paths of the entries of an archive that reference a blob."""
+        rows = self.select("""SELECT DISTINCT e.libpath FROM EntryHashes h JOIN ArchiveEntry e ON e.id = h.archive_entry_id
+                WHERE h.hash = ? AND h.archive_id = ? ORDER BY e.libpath""", hash2blob(hash), archive_id)
+        return [row['libpath'] for row in rows]
+
+    @classmethod
+    def generation_filter(cls, generation : int = None):
+        """Returns the SQL condition and parameters that select the entries 'e' in the snapshot of a generation, or
+        the current entries if generation is None.
+        """
+        if generation is None:
+            return "e.gen_to IS NULL", ()
+        return "e.gen_from <= ? AND (e.gen_to IS NULL OR e.gen_to > ?)", (generation, generation)
+
+    def pattern_filter(self, archive_id : int, apattern : ArchivePattern, generation : int = None):
+        """Returns the SQL condition and parameters that select the entries 'e' of an archive, narrowed to the candidates
+        for a pattern.  The literal prefix of the pattern becomes a range over the (archive_id, libpath) index; otherwise,
+        if the path search index exists, entries are looked up by the longest literal run of the pattern.  The
+        candidates must still be checked with apattern.match().  Only the entries of the given generation, or the
+        current entries, are selected.
+        """
+        gwhere, gargs = self.generation_filter(generation)
+        if apattern is None:
+            return f"e.archive_id = ? AND {gwhere}", (archive_id,) + gargs
+        low, high = prefix_range(apattern.prefix)
+        if high is not None:
+            return f"e.archive_id = ? AND e.libpath >= ? AND e.libpath < ? AND {gwhere}", (archive_id, low, high) + gargs
+        literal = apattern.literal
+        if self.has_path_search and len(literal) >= 3:
+            # a quoted string matches as a substring of the trigram tokenized path; the unary + keeps the
+            # planner from scanning the archive_id index instead of looking up the matching rowids
+            return (f"+e.archive_id = ? AND e.id IN (SELECT rowid FROM ArchivePathSearch WHERE ArchivePathSearch MATCH ?) AND {gwhere}",
+                    (archive_id, '"' + literal.replace('"', '""') + '"') + gargs)
+        return f"e.archive_id = ? AND {gwhere}", (archive_id,) + gargs
+
+    def iter_rows(self, archive_id : int, apattern : ArchivePattern = None):
+        """Yields the current entry rows of an archive in libpath order, optionally limited to the libpaths matching
+        a pattern.
+        """
+        where, args = self.pattern_filter(archive_id, apattern)
+        for row in self.cursor(f"SELECT e.id, e.libpath, e.size, e.mtime_ns, e.ctime_ns, e.inode FROM ArchiveEntry e WHERE {where} ORDER BY e.libpath",
+                               *args):
+            if apattern is None or apattern.match(row['libpath']):
+                yield row
+
+    def build_dirs(self, archive_id : int):
+        """Rebuild the ArchiveDir table of an archive from its entries.
+
+        Each directory row holds the total size and number of files in its subtree.  Only the per-directory
+        totals of the ArchiveEntry(archive_id, dirname) index are scanned; they are then rolled up to every
+        ancestor directory.
+        """
+        with self.transaction():
+            self.sql("DELETE FROM ArchiveDir WHERE archive_id = ?", archive_id)
+            self.sql(self.build_dirs_sql.format(where="WHERE archive_id = ? AND gen_to IS NULL"), archive_id)
+
+    def write_generation(self, archive_id : int) -> int:
+        """Start a new generation of an archive, or return the generation left unfinished by an interrupted backup."""
+        with self.transaction():
+            generation = self.select1("SELECT id FROM Generation WHERE archive_id = ? AND finished IS NULL", archive_id)
+            if generation is None:
+                parent = self.select1("SELECT MAX(id) FROM Generation WHERE archive_id = ?", archive_id)
+                generation = self.sql("INSERT INTO Generation(archive_id, parent, started) VALUES (?,?,?)",
+                                      archive_id, parent, int(time.time()))
+        return generation
+
+    def finish_generation(self, generation : int):
+        self.sql("UPDATE Generation SET finished = ? WHERE id = ?", int(time.time()), generation)
+
+    def read_generations(self, archive_id : int) -> List[dict]:
+        """Returns the generation rows ('id', 'parent', 'started', 'finished', 'added', 'removed') of an archive,
+        oldest first.  'added' counts the entries written by the generation and 'removed' the entries it replaced
+        or deleted.
+        """
+        return self.select("""SELECT g.id, g.parent, g.started, g.finished,
+                (SELECT COUNT(*) FROM ArchiveEntry e WHERE e.archive_id = g.archive_id AND e.gen_from = g.id) AS added,
+                (SELECT COUNT(*) FROM ArchiveEntry e WHERE e.archive_id = g.archive_id AND e.gen_to = g.id) AS removed
+                FROM Generation g WHERE g.archive_id = ? ORDER BY g.id""", archive_id)
+
+    def read_generation(self, archive_id : int, generation : int = None) -> dict:
+        """Returns the row ('id', 'parent', 'started', 'finished') of a generation of an archive, by default the
+        latest finished one, or None if there is no such generation.
+        """
+        if generation is None:
+            rows = self.select("SELECT id, parent, started, finished FROM Generation WHERE archive_id = ? AND finished IS NOT NULL ORDER BY id DESC LIMIT 1",
+                               archive_id)
+        else:
+            rows = self.select("SELECT id, parent, started, finished FROM Generation WHERE archive_id = ? AND id = ?",
+                               archive_id, generation)
+        return rows[0] if len(rows) > 0 else None
+
+    def prune_generations(self, archive_id : int, keep : int, dry_run : bool = False) -> tuple:
+        """Delete the generations of an archive older than its keep most recent finished ones, together with the
+        entry rows and hashes that only their snapshots contain, so that the blobs of old versions of modified
+        and removed files are no longer referenced.  Rows closed at or before the oldest kept generation are not
+        in any kept snapshot.
+
+        Args:
+            archive_id (int): The archive to prune.
+            keep (int): The number of finished generations to keep, at least 1.
+            dry_run (bool): If True, only count what would be deleted.
+
+        Returns:
+            tuple(ngenerations, nentries): The number of generations and of entry rows deleted.
+        """
+        oldest = self.select1("SELECT id FROM Generation WHERE archive_id = ? AND finished IS NOT NULL ORDER BY id DESC LIMIT 1 OFFSET ?",
+                              archive_id, max(1, keep) - 1)
+        if oldest is None:
+            return 0, 0
+        closed = "SELECT id FROM ArchiveEntry WHERE archive_id = ? AND gen_to IS NOT NULL AND gen_to <= ?"
+        with self.transaction():
+            ngenerations = self.select1("SELECT COUNT(*) FROM Generation WHERE archive_id = ? AND id < ?", archive_id, oldest)
+            nentries = self.select1(f"SELECT COUNT(*) FROM ({closed})", archive_id, oldest)
+            if not dry_run:
+                self.sql(f"DELETE FROM EntryHashes WHERE archive_entry_id IN ({closed})", archive_id, oldest)
+                self.sql(f"DELETE FROM RestoreJournal WHERE archive_entry_id IN ({closed})", archive_id, oldest)
+                self.sql("DELETE FROM ArchiveEntry WHERE archive_id = ? AND gen_to IS NOT NULL AND gen_to <= ?", archive_id, oldest)
+                self.sql("DELETE FROM Generation WHERE archive_id = ? AND id < ?", archive_id, oldest)
+                self.sql("UPDATE Generation SET parent = NULL WHERE id = ?", oldest)
+        return ngenerations, nentries
+
+    def begin_scan(self):
+        """Start recording the library paths seen by a backup scan, for close_unseen()."""
+        self.sql("CREATE TEMP TABLE IF NOT EXISTS ScanSeen (libpath TEXT PRIMARY KEY)")
+        self.sql("DELETE FROM temp.ScanSeen")
+
+    def mark_seen(self, libpaths : List[str]):
+        self.sqlmany("INSERT OR IGNORE INTO temp.ScanSeen(libpath) VALUES (?)", [(libpath,) for libpath in libpaths])
+
+    def mark_seen_under(self, archive_id : int, prefixes : List[str]):
+        """Mark the current entries under directories the scan could not read as seen, so that close_unseen() keeps
+        them instead of removing their files from the generation.
+
+        Args:
+            archive_id (int): The archive being scanned.
+            prefixes (List[str]): The library paths of the directories, ending in '/'.
+        """
+        for prefix in prefixes:
+            low, high = prefix_range(prefix)
+            self.sql("""INSERT OR IGNORE INTO temp.ScanSeen(libpath) SELECT libpath FROM ArchiveEntry
+                    WHERE archive_id = ? AND gen_to IS NULL AND libpath >= ? AND libpath < ?""", archive_id, low, high)
+
+    def close_unseen(self, archive_id : int, generation : int) -> int:
+        """Close the current entries whose files were not seen by the scan, removing them from the snapshot of the
+        generation and the ones after it.
+
+        Returns:
+            int: The number of entries removed.
+        """
+        with self.transaction():
+            self.sql("""UPDATE ArchiveEntry SET gen_to = ? WHERE archive_id = ? AND gen_to IS NULL
+                    AND libpath NOT IN (SELECT libpath FROM temp.ScanSeen)""", generation, archive_id)
+            return self.select1("SELECT changes()")
+
+    def diff_generations(self, archive_id : int, old : int, new : int):
+        """Yields ('libpath', 'change') for each file that differs between the snapshots of two generations, in
+        libpath order, where change is 'A' (added), 'D' (deleted) or 'M' (modified).
+
+        Only the entries written or closed by the generations after old and up to new are read, using the
+        (archive_id, gen_from) and (archive_id, gen_to) indexes, so the cost follows the number of changes rather
+        than the size of the archive.
+        """
+        for row in self.cursor("""
+                SELECT libpath,
+                    MAX(gen_from <= ? AND (gen_to IS NULL OR gen_to > ?)) AS in_old,
+                    MAX(gen_from <= ? AND (gen_to IS NULL OR gen_to > ?)) AS in_new
+                FROM ArchiveEntry
+                WHERE archive_id = ? AND ((gen_from > ? AND gen_from <= ?) OR (gen_to > ? AND gen_to <= ?))
+                GROUP BY libpath HAVING in_old OR in_new ORDER BY libpath""",
+                               old, old, new, new, archive_id, old, new, old, new):
+            change = 'M' if row['in_old'] and row['in_new'] else 'A' if row['in_new'] else 'D'
+            yield { 'libpath': row['libpath'], 'change': change }
+
+    def read_restored_parts(self, entry_id : int) -> set:
+        """Returns the part numbers of an entry written to the local mirror by an interrupted restore."""
+        return { row['part'] for row in self.select("SELECT part FROM RestoreJournal WHERE archive_entry_id = ?", entry_id) }
+
+    def write_restored_parts(self, parts : list):
+        """Record parts written to the local mirror.
+        Args:
+            parts (list): (entry id, part) tuples.
+        """
+        self.sqlmany("INSERT OR IGNORE INTO RestoreJournal(archive_entry_id, part) VALUES (?,?)", parts)
+
+    def clear_restored_parts(self, entry_ids : List[int]):
+        """Forget the parts written for entries whose files are complete, keeping the progress of other restores."""
+        self.sqlmany("DELETE FROM RestoreJournal WHERE archive_entry_id = ?", [(id,) for id in entry_ids])
+
+    def read_verify_checkpoint(self, archive_id : int, pattern : str) -> dict:
+        """Returns the checkpoint row ('libpath', 'nfiles', 'nbytes', 'nfailed') of an interrupted deep verify of
+        the pattern, or None.
+        """
+        rows = self.select("SELECT libpath, nfiles, nbytes, nfailed FROM VerifyCheckpoint WHERE archive_id = ? AND pattern = ?",
+                           archive_id, pattern)
+        return rows[0] if len(rows) > 0 else None
+
+    def write_verify_checkpoint(self, archive_id : int, pattern : str, libpath : str, nfiles : int, nbytes : int, nfailed : int):
+        """Record that a deep verify of the pattern has checked every entry up to and including libpath."""
+        self.sql("INSERT OR REPLACE INTO VerifyCheckpoint(archive_id, pattern, libpath, nfiles, nbytes, nfailed) VALUES (?,?,?,?,?,?)",
+                 archive_id, pattern, libpath, nfiles, nbytes, nfailed)
+
+    def del_verify_checkpoint(self, archive_id : int, pattern : str):
+        self.sql("DELETE FROM VerifyCheckpoint WHERE archive_id = ? AND pattern = ?", archive_id, pattern)
+
+    def read_dir(self, archive_id : int, path : str) -> tuple:
+        """List a directory of an archive.
+
+        Args:
+            archive_id (int): The archive to list.
+            path (str): The library path of the directory, without a trailing '/'; '' for the root directory.
+
+        Returns:
+            tuple(entries, directories): The entry rows of the files directly in the directory, and the ArchiveDir
+                rows ('path', 'nfiles', 'size') of its immediate subdirectories.
+        """
+        entries = self.select("SELECT id, libpath, size, mtime_ns, ctime_ns, inode FROM ArchiveEntry WHERE archive_id = ? AND dirname = ? AND gen_to IS NULL ORDER BY libpath",
+                              archive_id, path)
+        directories = self.select("SELECT path, nfiles, size FROM ArchiveDir WHERE archive_id = ? AND parent = ? ORDER BY path",
+                                  archive_id, path)
+        return entries, directories
+
+    def iter_entries(self, archive_id : int, apattern : ArchivePattern = None, generation : int = None):
+        """Yields the entries of an archive together with their hash lists in libpath order, streaming the rows from a
+        single query.  If a pattern is given, only matching entries are yielded.  The entries are those of the
+        snapshot of a generation, or the current entries if generation is None.
+        """
+        where, args = self.pattern_filter(archive_id, apattern, generation)
+        entry = None
+        for row in self.cursor(f"""
+                SELECT e.id, e.libpath, e.size, e.mtime_ns, e.ctime_ns, e.inode, h.hash, h.size AS partsize FROM ArchiveEntry e
+                LEFT JOIN EntryHashes h ON h.archive_entry_id = e.id
+                WHERE {where} ORDER BY e.libpath, e.id, h.seq""", *args):
+            if apattern is not None and not apattern.match(row['libpath']):
+                continue
+            if entry is None or entry.id != row['id']:
+                if entry is not None:
+                    yield entry
+                entry = ArchiveEntry(archive_id, row['libpath'], [], row['size'], row['id'],
+                                     row['mtime_ns'], row['ctime_ns'], row['inode'])
+            if row['hash'] is not None:
+                entry.hashlist.append(blob2hash(row['hash']))
+                entry.partsizes.append(row['partsize'])
+        if entry is not None:
+            yield entry
+
+
+    # Optional trigram index of ArchiveEntry.libpath, created by create_path_search()
+    path_search_schema = """
+BEGIN;
+CREATE VIRTUAL TABLE ArchivePathSearch USING fts5(libpath, tokenize='trigram', content='ArchiveEntry', content_rowid='id');
+CREATE TRIGGER ArchivePathSearchInsert AFTER INSERT ON ArchiveEntry BEGIN
+    INSERT INTO ArchivePathSearch(rowid, libpath) VALUES (new.id, new.libpath);
+END;
+CREATE TRIGGER ArchivePathSearchDelete AFTER DELETE ON ArchiveEntry BEGIN
+    INSERT INTO ArchivePathSearch(ArchivePathSearch, rowid, libpath) VALUES ('delete', old.id, old.libpath);
+END;
+CREATE TRIGGER ArchivePathSearchUpdate AFTER UPDATE OF libpath ON ArchiveEntry BEGIN
+    INSERT INTO ArchivePathSearch(ArchivePathSearch, rowid, libpath) VALUES ('delete', old.id, old.libpath);
+    INSERT INTO ArchivePathSearch(rowid, libpath) VALUES (new.id, new.libpath);
+END;
+INSERT INTO ArchivePathSearch(ArchivePathSearch) VALUES ('rebuild');
+COMMIT;
+"""
+
+    # Rolls the per-directory file counts and sizes of ArchiveEntry up into ArchiveDir rows for every ancestor
+    # directory.  {where} selects the archives to build.
+    build_dirs_sql = """
+INSERT INTO ArchiveDir(archive_id, path, parent, nfiles, size)
+WITH RECURSIVE direct(archive_id, dir, nfiles, size) AS (
+    SELECT archive_id, dirname, COUNT(*), SUM(size) FROM ArchiveEntry {where} GROUP BY archive_id, dirname
+), tree(archive_id, dir, nfiles, size) AS (
+    SELECT archive_id, dir, nfiles, size FROM direct
+    UNION ALL SELECT archive_id, libdir(dir), nfiles, size FROM tree WHERE dir <> ''
+)
+SELECT archive_id, dir, CASE WHEN dir = '' THEN NULL ELSE libdir(dir) END, SUM(nfiles), SUM(size)
+    FROM tree GROUP BY archive_id, dir
+"""
+
+    # condition selecting the objects 'b' of Blobs that no entry of any archive references, directly or through a pack
+    orphan_sql = """NOT EXISTS (SELECT 1 FROM EntryHashes h WHERE h.hash = b.hash)
+        AND NOT EXISTS (SELECT 1 FROM PackedBlobs p JOIN EntryHashes h ON h.hash = p.hash WHERE p.pack = b.hash)"""
 
     # Schema versions and DDL scripts to initialize and upgrade the database schema.  Note that the
     # schema version is stored in the SchemaVersion table starting at version 0 with no other tables,
     # so the first usable schema version is 1.
-    schema_target_ver = 1
+    schema_target_ver = 13
     schema = {
         1: """
 CREATE TABLE IF NOT EXISTS Archive (
@@ -256,5 +913,163 @@ CREATE TABLE IF NOT EXISTS EntryHashes (
 );
 --CREATE UNIQUE INDEX (archive_entry, order) on EntryHashes;
 --CREATE UNIQUE INDEX (archive) on ArchiveEntry;
+""",
+        # v2: stat cache for incremental backups
+        2: """
+ALTER TABLE ArchiveEntry ADD COLUMN mtime_ns INTEGER;
+ALTER TABLE ArchiveEntry ADD COLUMN ctime_ns INTEGER;
+ALTER TABLE ArchiveEntry ADD COLUMN inode INTEGER;
+""",
+        # v3: lookup indexes, and hashes stored as binary digests instead of hex text
+        3: """
+CREATE TABLE EntryHashes_v3 (
+    archive_id INTEGER,
+    archive_entry_id INTEGER,
+    seq INTEGER,
+    hash BLOB,
+    FOREIGN KEY(archive_id) REFERENCES Archive (id),
+    FOREIGN KEY(archive_entry_id) REFERENCES ArchiveEntry(id)
+);
+INSERT INTO EntryHashes_v3(archive_id, archive_entry_id, seq, hash)
+    SELECT archive_id, archive_entry_id, seq, hash2blob(hash) FROM EntryHashes;
+DROP TABLE EntryHashes;
+ALTER TABLE EntryHashes_v3 RENAME TO EntryHashes;
+CREATE UNIQUE INDEX EntryHashesEntrySeq ON EntryHashes(archive_entry_id, seq);
+CREATE INDEX EntryHashesHash ON EntryHashes(hash);
+CREATE INDEX ArchiveEntryArchivePath ON ArchiveEntry(archive_id, libpath);
+""",
+        # v4: directory tree for listings
+        4: """
+ALTER TABLE ArchiveEntry ADD COLUMN dirname TEXT;
+UPDATE ArchiveEntry SET dirname = libdir(libpath);
+CREATE INDEX ArchiveEntryArchiveDir ON ArchiveEntry(archive_id, dirname);
+CREATE TABLE ArchiveDir (
+    archive_id INTEGER,
+    path TEXT,
+    parent TEXT,
+    nfiles INTEGER,
+    size INTEGER,
+    FOREIGN KEY(archive_id) REFERENCES Archive (id)
+);
+CREATE UNIQUE INDEX ArchiveDirPath ON ArchiveDir(archive_id, path);
+CREATE INDEX ArchiveDirParent ON ArchiveDir(archive_id, parent);
+""" + build_dirs_sql.format(where=""),
+        # v5: part sizes for content-defined chunking; NULL for fixed MAXBLOB parts stored earlier
+        5: """
+ALTER TABLE EntryHashes ADD COLUMN size INTEGER;
+""",
+        # v6: locations of small blobs stored inside pack objects
+        6: """
+CREATE TABLE PackedBlobs (
+    hash BLOB PRIMARY KEY,
+    pack BLOB,
+    offset INTEGER,
+    length INTEGER
+);
+CREATE INDEX PackedBlobsPack ON PackedBlobs(pack);
+""",
+        # v7: content hash algorithm per archive; archives created earlier use md5
+        7: """
+ALTER TABLE Archive ADD COLUMN hashalg TEXT;
+UPDATE Archive SET hashalg = 'md5';
+""",
+        # v8: progress of an interrupted deep verify, by archive and pattern
+        8: """
+CREATE TABLE VerifyCheckpoint (
+    archive_id INTEGER,
+    pattern TEXT,
+    libpath TEXT,
+    nfiles INTEGER,
+    nbytes INTEGER,
+    nfailed INTEGER,
+    PRIMARY KEY (archive_id, pattern)
+);
+""",
+        # v9: when each stored blob was last fetched and rehashed by a scrub, and whether it was intact
+        9: """
+CREATE TABLE ScrubStatus (
+    hash BLOB PRIMARY KEY,
+    scrubbed INTEGER,
+    ok INTEGER
+);
+CREATE INDEX ScrubStatusScrubbed ON ScrubStatus(scrubbed);
+""",
+        # v10: the objects in the object store, for garbage collection, and leases that keep garbage collection and
+        # backups from running at the same time.  Objects stored before v10 are recorded as stored now.
+        10: """
+CREATE TABLE Blobs (
+    hash BLOB PRIMARY KEY,
+    size INTEGER,
+    stored INTEGER,
+    unreferenced INTEGER
+);
+INSERT OR IGNORE INTO Blobs(hash, stored)
+    SELECT DISTINCT hash, CAST(strftime('%s', 'now') AS INTEGER) FROM EntryHashes
+    WHERE hash NOT IN (SELECT hash FROM PackedBlobs);
+INSERT OR IGNORE INTO Blobs(hash, stored)
+    SELECT DISTINCT pack, CAST(strftime('%s', 'now') AS INTEGER) FROM PackedBlobs;
+CREATE TABLE ArchiveLease (
+    id INTEGER PRIMARY KEY,
+    kind TEXT,
+    started INTEGER,
+    heartbeat INTEGER
+);
+""",
+        # v11: generations.  Each backup writes a generation; an entry row belongs to the snapshots of the
+        # generations from gen_from up to, but not including, gen_to (NULL while it is current), so unchanged
+        # entries are shared by every snapshot.  Existing entries form the first generation of their archive.
+        11: """
+CREATE TABLE Generation (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    archive_id INTEGER,
+    parent INTEGER,
+    started INTEGER,
+    finished INTEGER,
+    FOREIGN KEY(archive_id) REFERENCES Archive (id)
+);
+CREATE INDEX GenerationArchive ON Generation(archive_id, id);
+INSERT INTO Generation(archive_id, started, finished)
+    SELECT id, CAST(strftime('%s', 'now') AS INTEGER), CAST(strftime('%s', 'now') AS INTEGER) FROM Archive;
+ALTER TABLE ArchiveEntry ADD COLUMN gen_from INTEGER;
+ALTER TABLE ArchiveEntry ADD COLUMN gen_to INTEGER;
+UPDATE ArchiveEntry SET gen_from = (SELECT id FROM Generation g WHERE g.archive_id = ArchiveEntry.archive_id);
+CREATE INDEX ArchiveEntryCurrentPath ON ArchiveEntry(archive_id, gen_to, libpath);
+CREATE INDEX ArchiveEntryGenFrom ON ArchiveEntry(archive_id, gen_from);
+""",
+        # v12: parts written by a restore, so that an interrupted restore does not fetch them again
+        12: """
+CREATE TABLE RestoreJournal (
+    archive_entry_id INTEGER,
+    part INTEGER,
+    PRIMARY KEY (archive_entry_id, part)
+);
+""",
+        # v13: one Archive row per name.  Before v2 every backup inserted another Archive row with the same name,
+        # which v11 turned into a generation each.  The rows of a name are merged into the first one, their
+        # generations are chained in order, and the entries of each row are closed by the generation of the next.
+        13: """
+CREATE TEMP TABLE ArchiveMerge AS
+    SELECT a.id AS old_id,
+        (SELECT MIN(b.id) FROM Archive b WHERE b.name IS a.name) AS new_id,
+        (SELECT MIN(g.id) FROM Archive b JOIN Generation g ON g.archive_id = b.id WHERE b.name IS a.name AND b.id > a.id) AS next_gen
+    FROM Archive a;
+UPDATE ArchiveEntry SET gen_to = (SELECT next_gen FROM temp.ArchiveMerge WHERE old_id = ArchiveEntry.archive_id)
+    WHERE gen_to IS NULL AND archive_id IN (SELECT old_id FROM temp.ArchiveMerge WHERE next_gen IS NOT NULL);
+UPDATE Generation SET parent = (SELECT MAX(p.id) FROM Generation p JOIN temp.ArchiveMerge m ON m.old_id = p.archive_id
+        WHERE m.new_id = (SELECT new_id FROM temp.ArchiveMerge WHERE old_id = Generation.archive_id) AND p.id < Generation.id)
+    WHERE parent IS NULL AND archive_id IN (SELECT old_id FROM temp.ArchiveMerge WHERE old_id <> new_id);
+UPDATE ArchiveEntry SET archive_id = (SELECT new_id FROM temp.ArchiveMerge WHERE old_id = ArchiveEntry.archive_id)
+    WHERE archive_id IN (SELECT old_id FROM temp.ArchiveMerge WHERE old_id <> new_id);
+UPDATE EntryHashes SET archive_id = (SELECT new_id FROM temp.ArchiveMerge WHERE old_id = EntryHashes.archive_id)
+    WHERE archive_id IN (SELECT old_id FROM temp.ArchiveMerge WHERE old_id <> new_id);
+UPDATE Generation SET archive_id = (SELECT new_id FROM temp.ArchiveMerge WHERE old_id = Generation.archive_id)
+    WHERE archive_id IN (SELECT old_id FROM temp.ArchiveMerge WHERE old_id <> new_id);
+DELETE FROM VerifyCheckpoint WHERE archive_id IN (SELECT old_id FROM temp.ArchiveMerge WHERE old_id <> new_id);
+DELETE FROM ArchiveDir WHERE archive_id IN (SELECT old_id FROM temp.ArchiveMerge WHERE old_id <> new_id)
+    OR archive_id IN (SELECT new_id FROM temp.ArchiveMerge WHERE old_id <> new_id);
+""" + build_dirs_sql.format(where="WHERE gen_to IS NULL AND archive_id IN (SELECT new_id FROM temp.ArchiveMerge WHERE old_id <> new_id)") + """;
+DELETE FROM Archive WHERE id IN (SELECT old_id FROM temp.ArchiveMerge WHERE old_id <> new_id);
+DROP TABLE temp.ArchiveMerge;
+CREATE UNIQUE INDEX ArchiveName ON Archive(name);
 """
 }
@@ -1,19 +1,57 @@
-from typing import List
+import os
+from typing import Iterator, List
+from .archive_chunker import MAXBLOB
 
 class ArchiveEntry:
     seq_id = 0
-    def __init__(self, archive_id : int, libpath : str, hashlist : List[str], size : int, id : int = None):
+    def __init__(self, archive_id : int, libpath : str, hashlist : List[str], size : int, id : int = None,
+                 mtime_ns : int = None, ctime_ns : int = None, inode : int = None, partsizes : List[int] = None):
         self.archive_id = archive_id
         self.id = id if id is not None else self.next_seq_id()
         self.libpath : str = libpath
         self.hashlist : List[str] = hashlist
+        # length of each part; None for parts stored before part sizes were recorded, which are MAXBLOB long
+        self.partsizes : List[int] = partsizes if partsizes is not None else [None] * len(hashlist)
         self.size : int = size
+        # stat cache used by incremental backups to detect unchanged files
+        self.mtime_ns : int = mtime_ns
+        self.ctime_ns : int = ctime_ns
+        self.inode : int = inode
 
     @classmethod
     def next_seq_id(cls):
         cls.seq_id -= 1
         return cls.seq_id
 
+    def set_stat(self, st : os.stat_result):
+        """Record the size and change-detection fields of a stat result in the entry."""
+        self.size = st.st_size
+        self.mtime_ns = st.st_mtime_ns
+        self.ctime_ns = st.st_ctime_ns
+        self.inode = st.st_ino
+
+    @classmethod
+    def stat_matches(cls, row : dict, st : os.stat_result) -> bool:
+        """Returns True if a stored entry row describes the same file contents as the stat result.
+
+        Rows written before the stat cache existed have no mtime and never match.
+        """
+        return (row.get('mtime_ns') is not None
+                and row['size'] == st.st_size
+                and row['mtime_ns'] == st.st_mtime_ns
+                and row['ctime_ns'] == st.st_ctime_ns
+                and row['inode'] == st.st_ino)
+
+    def parts(self) -> Iterator[tuple]:
+        """Yields (part, hash, offset, length) for each part of the entry in order."""
+        offset = 0
+        for part, h in enumerate(self.hashlist):
+            length = self.partsizes[part]
+            if length is None:
+                length = min(MAXBLOB, self.size - offset)
+            yield part, h, offset, length
+            offset += length
+
     def serialize(self):
         return [
             { "libpath":self.libpath, "part":i, "hash":self.hashlist[i], "size":self.size }
@@ -0,0 +1,75 @@
+from typing import Iterator
+import time
+
+
+class ArchiveCollector:
+    def __init__(self, objects, data, grace : int = 86400, batch : int = 100):
+        """Deletes objects from the object store that no entry references any more, by mark and sweep over the
+        Blobs table, which records every object uploaded.
+
+        Each run first marks the objects that have become unreferenced with the current time, and clears the mark
+        of objects that are referenced again.  It then deletes the objects that were stored and marked at least
+        grace seconds ago and are still unreferenced, so an object is only deleted after it has stayed unreferenced
+        for the whole grace period, as seen by two runs.  A pack is deleted once none of its blobs is referenced.
+        Unreferenced blobs in packs that are still in use are not reclaimed.
+
+        Objects are deleted concurrently through the object store's batch interface, up to its 'connections'
+        limit.  The caller must hold a 'gc' lease, which keeps backups from running during the sweep.
+
+        Args:
+            objects (ArchiveObject): The object store.
+            data (ArchiveData): The index database.
+            grace (int): The grace period in seconds.
+            batch (int): The number of deleted objects forgotten in the index at a time.
+        """
+        self.objects = objects
+        self.data = data
+        self.grace = grace
+        self.batch = batch
+        self.nmarked = 0
+        self.ndeleted = 0
+        self.nfailed = 0
+        self.bytes_freed = 0
+        self.ntotal = None  # the number of objects this run deletes, once known
+
+    def collect(self, dry_run : bool = False) -> Iterator[tuple]:
+        """Marks unreferenced objects and deletes those past the grace period.
+
+        Args:
+            dry_run (bool): If True, only report the objects that would be deleted.
+
+        Yields:
+            tuple(hash, size, message): Each object deleted (or that would be deleted), with None as the message,
+                or with an error message if it could not be deleted.
+        """
+        now = int(time.time())
+        self.nmarked = self.data.mark_orphans(now)
+        orphans = self.data.read_orphans(now - self.grace)
+        self.ntotal = len(orphans)
+        if dry_run:
+            for row in orphans:
+                self.ndeleted += 1
+                self.bytes_freed += row['size'] or 0
+                yield row['hash'], row['size'], None
+            return
+        rows = { self.objects.hashpath(row['hash']): row for row in orphans }
+        deleted = []
+        try:
+            for path, error in self.objects.store.delete_many(rows.keys()):
+                row = rows[path]
+                if error is not None:
+                    self.nfailed += 1
+                    yield row['hash'], None, str(error)
+                    continue
+                deleted.append(row['hash'])
+                if len(deleted) >= self.batch:
+                    self.data.del_blobs(deleted)
+                    deleted = []
+                self.ndeleted += 1
+                self.bytes_freed += row['size'] or 0
+                self.objects.metrics.add('objects_deleted')
+                self.objects.metrics.add('bytes_freed', row['size'] or 0)
+                yield row['hash'], row['size'], None
+        finally:
+            if deleted:
+                self.data.del_blobs(deleted)
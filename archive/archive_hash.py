@@ -0,0 +1,63 @@
+import base64
+import hashlib
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+# Content hash algorithms by the name recorded in the Archive table.  hashlib releases the GIL while digesting
+# large buffers, so these can be run in parallel on a thread pool.
+HASHES = {
+    "md5": lambda: hashlib.md5(),
+    "sha256": lambda: hashlib.sha256(),
+    "blake2b": lambda: hashlib.blake2b(digest_size=16),
+}
+if blake3 is not None:
+    HASHES["blake3"] = lambda: blake3.blake3(max_threads=1)
+
+
+def make_hasher(name : str):
+    """Returns a function that computes the hex content hash of a blob with the named algorithm.
+
+    Raises:
+        ValueError: If the algorithm is unknown or its optional package is not installed.
+    """
+    if name not in HASHES:
+        raise ValueError(f"Unknown or unavailable hash algorithm '{name}'")
+    new = HASHES[name]
+    def hasher(blob) -> str:
+        h = new()
+        h.update(blob)
+        return base64.b16encode(h.digest()).decode('ASCII')
+    return hasher
+
+
+def benchmark(size : int = 32*1024*1024, rounds : int = 8, workers : int = os.cpu_count()):
+    """Prints the hashing throughput of each available algorithm on this machine, on one thread and on a pool
+    of worker threads.
+
+    Args:
+        size (int): The size of each buffer hashed, MAXBLOB by default.
+        rounds (int): The number of buffers hashed per measurement.
+        workers (int): The number of threads in the pool.
+    """
+    buf = os.urandom(size)
+    print(f"{'hash':10s} {'1 thread':>12s} {f'{workers} threads':>12s}")
+    for name in HASHES:
+        hasher = make_hasher(name)
+        t0 = time.perf_counter()
+        for _ in range(rounds):
+            hasher(buf)
+        serial = size * rounds / (time.perf_counter() - t0)
+        with ThreadPoolExecutor(workers) as pool:
+            t0 = time.perf_counter()
+            list(pool.map(hasher, [buf] * rounds * workers))
+            parallel = size * rounds * workers / (time.perf_counter() - t0)
+        print(f"{name:10s} {serial/1e6:>9.0f}MB/s {parallel/1e6:>9.0f}MB/s")
+
+
+if __name__ == "__main__":
+    benchmark()
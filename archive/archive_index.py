@@ -1,60 +1,160 @@
+from bisect import bisect_left
 from .archive_entry import ArchiveEntry
-from .archive_data import ArchiveData
+from .archive_data import ArchiveData, prefix_range
 from .archive_config import ArchiveConfig
-from typing import List
+from .archive_pattern import ArchivePattern
+from typing import Iterator, List
 
 class ArchiveIndex:
     def __init__(self, config : ArchiveConfig, adata : ArchiveData):
 
+        self.data = adata
         t = adata.read_entries(config.archive_name)
         if t:
-            archive_id, ihashes, index = t
+            archive_id, ihashes, index, isizes = t
             if config.debug:
                 print(f"ArchiveIndex: {config.archive_name} loaded {len(index)} entries and {len(ihashes.keys())} hashes")
             self.archive_id = archive_id   # identifier for the archive
             self.ihashes = ihashes  # entry_id -> [hashes]
+            self.isizes = isizes  # entry_id -> [part sizes]
             self.entries = index  # entry_id -> { 'id', 'libpath', 'size' }
             self.all_hashes = set()
             for _key,hlist in self.ihashes.items():
                 for h in hlist:
                     self.all_hashes.add(h)
-            # self.byname = { i['libpath'] : i['id'] for i in index }
+            self.byname = { e['libpath'] : e for e in index.values() }  # libpath -> entry
         else:
             if config.debug:
                 print("ArchiveIndex:", config.archive_name)
             self.archive_id = -1
             self.ihashes = {}
+            self.isizes = {}
             self.entries = {}
             self.all_hashes = set()
-            # self.byname = {}
+            self.byname = {}
+        # blobs stored by a backup that was interrupted before its entries were committed are not uploaded again
+        self.all_hashes.update(adata.read_stored_hashes())
+        self.ordered = None  # the entry rows sorted by libpath, and their libpaths, built on first use
+        self.paths = None
+
+    def lookup(self, libpath : str) -> dict:
+        """Returns the entry row for a library path, or None if it is not in the archive."""
+        return self.byname.get(libpath)
+
+    def entry_hashes(self, row : dict) -> List[str]:
+        """Returns the hash list of an entry row, in part order."""
+        return self.ihashes[row['id']] if row['size'] > 0 else []
+
+    def entry_partsizes(self, row : dict) -> List[int]:
+        """Returns the part sizes of an entry row, in part order."""
+        return self.isizes[row['id']] if row['size'] > 0 else []
 
     def hashes(self, libpath : str) -> List[str]:
-        return self.libpath[libpath]
+        return self.entry_hashes(self.byname[libpath])
 
     def has_hash(self, hash : str) -> bool:
         return hash in self.all_hashes
 
-    def idir(self, prefix : str) -> List[int]:
-        if len(prefix) > 0 and not prefix.endswith('/'):
-            prefix += '/'
-        nsep = prefix.count('/')
+    def sorted_rows(self) -> List[dict]:
+        """Returns the entry rows of the archive ordered by libpath, sorted once on first use."""
+        if self.ordered is None:
+            self.ordered = sorted(self.entries.values(), key=lambda e: e['libpath'])
+            self.paths = [e['libpath'] for e in self.ordered]
+        return self.ordered
+
+    def rows(self) -> Iterator[dict]:
+        """Yields the entry rows of the archive, ordered by libpath like those of the lazy index."""
+        return iter(self.sorted_rows())
+
+    def find(self, pattern : str) -> Iterator[dict]:
+        """Yields the entry rows whose libpath matches a shell-style pattern.  The literal prefix of the pattern
+        is located by bisection in the sorted rows, and only the rows sharing it are matched.
+        """
+        apattern = ArchivePattern(pattern)
+        rows = self.sorted_rows()
+        low, high = prefix_range(apattern.prefix)
+        for i in range(bisect_left(self.paths, low), len(rows)):
+            if high is not None and self.paths[i] >= high:
+                break
+            if apattern.match(self.paths[i]):
+                yield rows[i]
+
+    def iter_entries(self, pattern : str = None, generation : int = None) -> Iterator[ArchiveEntry]:
+        """Yields the entries of the archive with their hash lists, optionally only those matching a pattern.
+
+        Only the current entries are held in memory; the entries of an earlier generation are read from the
+        database.
+        """
+        if generation is not None:
+            yield from self.data.iter_entries(self.archive_id, ArchivePattern(pattern) if pattern else None, generation)
+            return
+        for row in (self.find(pattern) if pattern else self.rows()):
+            yield ArchiveEntry(self.archive_id, row['libpath'], self.entry_hashes(row), row['size'], row['id'],
+                               row['mtime_ns'], row['ctime_ns'], row['inode'], self.entry_partsizes(row))
+
+    def idir(self, prefix : str) -> tuple:
+        """Lists a directory of the archive from the directory table, touching only its immediate children.
+
+        Returns:
+            tuple(entries, directories): The entry rows of the files directly in the directory, and the rows
+                ('path', 'nfiles', 'size') of its immediate subdirectories with the totals of their subtrees.
+        """
+        return self.data.read_dir(self.archive_id, prefix.rstrip('/'))
+
 
-        entries = []
-        directories = []
-        for i,e in self.entries.items():
-            lpath :str = e['libpath']
-            if lpath.startswith(prefix):
-                if lpath.count('/')==nsep:
-                    entries.append(e['id'])
-                else:
-                    ldir = lpath[0:lpath.find('/', len(prefix))]
-                    if not ldir in directories:
-                        directories.append(ldir)
-        return entries, directories
+class IndexedHashSet:
+    def __init__(self, adata : ArchiveData, archive_id : int):
+        """A set of blob hashes backed by the EntryHashes table of an archive and the record of stored blobs.
 
+        Membership tests are answered by an indexed query.  Hashes added to the set are kept in memory for the
+        rest of the run, covering blobs that have been stored but whose entries are not yet written.
+        """
+        self.data = adata
+        self.archive_id = archive_id
+        self.added = set()
 
+    def __contains__(self, hash : str) -> bool:
+        return hash in self.added or self.data.has_hash(self.archive_id, hash) or self.data.has_stored(hash)
 
+    def add(self, hash : str):
+        self.added.add(hash)
 
+    def discard(self, hash : str):
+        self.added.discard(hash)
+
+
+class LazyArchiveIndex(ArchiveIndex):
+    def __init__(self, config : ArchiveConfig, adata : ArchiveData):
+        """An ArchiveIndex that answers every lookup with an indexed query or a streamed cursor instead of loading
+        the archive into memory.  Memory use stays roughly constant regardless of the size of the archive.
+        """
+        archive_id = adata.read_archive_id(config.archive_name)
+        if config.debug:
+            print("LazyArchiveIndex:", config.archive_name, archive_id)
+        self.data = adata
+        self.archive_id = archive_id if archive_id is not None else -1
+        self.all_hashes = IndexedHashSet(adata, self.archive_id)
+
+    def lookup(self, libpath : str) -> dict:
+        return self.data.read_entry(self.archive_id, libpath)
+
+    def entry_hashes(self, row : dict) -> List[str]:
+        return self.data.read_hashes(row['id']) if row['size'] > 0 else []
+
+    def entry_partsizes(self, row : dict) -> List[int]:
+        return self.data.read_partsizes(row['id']) if row['size'] > 0 else []
+
+    def hashes(self, libpath : str) -> List[str]:
+        return self.entry_hashes(self.lookup(libpath))
+
+    def has_hash(self, hash : str) -> bool:
+        return self.data.has_hash(self.archive_id, hash)
 
+    def rows(self) -> Iterator[dict]:
+        return self.data.iter_rows(self.archive_id)
 
+    def find(self, pattern : str) -> Iterator[dict]:
+        return self.data.iter_rows(self.archive_id, ArchivePattern(pattern))
 
+    def iter_entries(self, pattern : str = None, generation : int = None) -> Iterator[ArchiveEntry]:
+        return self.data.iter_entries(self.archive_id, ArchivePattern(pattern) if pattern else None, generation)
@@ -0,0 +1,235 @@
+from contextlib import contextmanager
+from math import log10, floor
+import json
+import sys
+import threading
+import time
+
+
+def human_readable(value):
+    suffix={
+        3: "kB",
+        6: "MB",
+        9: "GB",
+        12: "TB",
+        15: "PB"
+    }
+    if value == 0:
+        return "0B"
+    elevel = (floor(log10(value))//3*3)
+    if elevel == 0:
+        return f"{value}B"
+    return f"{value / (10**elevel):.0f}{suffix[elevel]}"
+
+
+class Histogram:
+    def __init__(self):
+        """A latency histogram with power of two buckets in microseconds, cheap enough to record every call."""
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = {}  # k -> number of samples below 2**k microseconds, and at least 2**(k-1)
+
+    def observe(self, seconds : float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        k = int(seconds * 1e6).bit_length()
+        self.buckets[k] = self.buckets.get(k, 0) + 1
+
+    def quantile(self, q : float) -> float:
+        """Returns an upper bound of the q quantile in seconds, within a factor of two."""
+        rank = q * self.count
+        seen = 0
+        for k in sorted(self.buckets):
+            seen += self.buckets[k]
+            if seen >= rank:
+                return round(min(2**k / 1e6, self.max), 6)
+        return self.max
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "total": round(self.total, 6),
+            "mean": round(self.total / self.count, 6) if self.count > 0 else 0.0,
+            "p50": self.quantile(0.50),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+            "max": round(self.max, 6),
+        }
+
+
+class ArchiveMetrics:
+    def __init__(self):
+        """Counters and latency histograms shared by the components of a run.
+
+        Counters count bytes, blobs and files by name; histograms record the latency of the hot paths by stage:
+        'hash', 'put_blob', 'upload', 'get_blob', 'write_entry' and 'sqlite'.  All methods are safe to call from
+        worker threads.
+        """
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.counters = {}
+        self.histograms = {}
+
+    def add(self, name : str, n : int = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def get(self, name : str) -> int:
+        return self.counters.get(name, 0)
+
+    def observe(self, name : str, seconds : float):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(seconds)
+
+    @contextmanager
+    def timer(self, name : str):
+        """Records the time spent in the enclosed block in the named histogram."""
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - t0)
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def seconds(self, name : str) -> float:
+        """Returns the total time recorded in the named histogram."""
+        h = self.histograms.get(name)
+        return h.total if h is not None else 0.0
+
+    def summary(self, command : str = None) -> dict:
+        """Returns the metrics of the run so far as a dictionary suitable for JSON."""
+        elapsed = self.elapsed
+        with self.lock:
+            counters = dict(sorted(self.counters.items()))
+            latency = { name: h.summary() for name, h in sorted(self.histograms.items()) }
+        return {
+            "command": command,
+            "time": int(time.time()),
+            "elapsed": round(elapsed, 3),
+            "counters": counters,
+            "rates": { name: round(value / elapsed, 1) for name, value in counters.items() } if elapsed > 0 else {},
+            "latency": latency,
+        }
+
+    def write_json(self, path : str, command : str = None, stream = None):
+        """Writes the summary as a line of JSON to a file, or to stream if path is '-'.  The file is appended to, so
+        a monitoring job can collect the summaries of successive runs.
+
+        Args:
+            path (str): The file to append to, or '-'.
+            command (str): The command the summary is for.
+            stream: Where the summary is written if path is '-'.  Defaults to stdout; commands that write their
+                data to stdout pass stderr instead.
+        """
+        line = json.dumps(self.summary(command)) + "\n"
+        if path == "-":
+            (stream if stream is not None else sys.stdout).write(line)
+        else:
+            with open(path, "at") as f:
+                f.write(line)
+
+
+class ArchiveProgress:
+    def __init__(self, metrics : ArchiveMetrics, label : str, done : str, count : str = None, enabled : bool = True,
+                 interval : float = 0.5, stream = None):
+        """A live progress line, redrawn on a background thread from the counters of a run.
+
+        The line shows the done counter in bytes with its throughput, the count counter with its rate, the time
+        spent in SQLite, and once the total amount of work is known, the percentage done and the time remaining.
+        Use as a context manager around the work, and print per-file lines with print() so they do not mix with
+        the progress line.
+
+        Args:
+            metrics (ArchiveMetrics): The metrics of the run.
+            label (str): The command name shown at the start of the line.
+            done (str): The counter of bytes processed.
+            count (str): An optional counter of items (blobs or files) processed.
+            enabled (bool): If False, nothing is drawn and print() is the builtin print.
+            interval (float): Seconds between redraws.
+            stream: Where the line is drawn, stderr by default.
+        """
+        self.metrics = metrics
+        self.label = label
+        self.done = done
+        self.count = count
+        self.enabled = enabled
+        self.interval = interval
+        self.stream = stream if stream is not None else sys.stderr
+        self.total = None
+        self.total_counter = done
+        self.lock = threading.Lock()  # keeps the line and the printed lines apart
+        self.stop = threading.Event()
+        self.thread = None
+        self.drawn = False
+        self.started = time.perf_counter()
+
+    def set_total(self, total, counter : str = None):
+        """Sets the total amount of work, in units of the done counter or of another counter.
+
+        Args:
+            total: The total, or a function returning it, or None while it is not known yet.
+            counter (str): The counter the total applies to.  Defaults to the done counter.
+        """
+        self.total = total
+        self.total_counter = counter if counter is not None else self.done
+
+    def line(self) -> str:
+        m = self.metrics
+        elapsed = max(time.perf_counter() - self.started, 1e-9)
+        done = m.get(self.done)
+        parts = [f"{human_readable(done)} ({human_readable(int(done / elapsed))}/s)"]
+        if self.count is not None:
+            n = m.get(self.count)
+            parts.append(f"{n} {self.count.split('_')[0]} ({n / elapsed:.0f}/s)")
+        parts.append(f"sqlite {m.seconds('sqlite'):.1f}s")
+        total = self.total() if callable(self.total) else self.total
+        if total:
+            progress = m.get(self.total_counter)
+            fraction = min(progress / total, 1.0)
+            if fraction > 0:
+                remaining = int(elapsed * (1 - fraction) / fraction)
+                parts.append(f"{fraction*100:.0f}% ETA {remaining//3600}:{remaining//60%60:02d}:{remaining%60:02d}")
+        return f"{self.label}: " + ", ".join(parts)
+
+    def _clear(self):
+        if self.drawn:
+            self.stream.write("\r\x1b[K")
+            self.stream.flush()
+            self.drawn = False
+
+    def _draw(self):
+        with self.lock:
+            self.stream.write("\r\x1b[K" + self.line())
+            self.stream.flush()
+            self.drawn = True
+
+    def _run(self):
+        while not self.stop.wait(self.interval):
+            self._draw()
+
+    def print(self, *args):
+        """Prints a line to stdout above the progress line."""
+        with self.lock:
+            self._clear()
+            print(*args)
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        if self.enabled:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.thread is not None:
+            self.stop.set()
+            self.thread.join()
+            with self.lock:
+                self._clear()
@@ -1,43 +1,291 @@
 from multicloud.autocontext import Context as MultiCloudContext
-from hashlib import md5
-import base64
+from concurrent.futures import Future
+from typing import Iterable, Iterator
 import os
 import sys
+import threading
+import time
 from .archive_config import ArchiveConfig
 from .archive_entry import ArchiveEntry
-
-def KiB(n): return n*1024
-def MiB(n): return KiB(n)*1024
-def GiB(n): return MiB(n)*1024
+from .archive_chunker import KiB, MiB, GiB, MAXBLOB, make_chunker
+from .archive_pack import ArchivePacker
+from .archive_codec import ArchiveCodec
+from .archive_hash import make_hasher
+from .archive_verify import check_file
+from .archive_cache import ArchiveCache
+from .archive_metrics import ArchiveMetrics
+from .archive_store import ArchiveStore
+from .archive_reader import ArchiveReader
 
 
 CONFIG="~/.archive.json"
 LIBRARY="library"
-MAXBLOB=MiB(32)
 
 
 class ArchiveObject:
-    def __init__(self, config : ArchiveConfig):
+    def __init__(self, config : ArchiveConfig, known_hashes : set = None, data = None, hashalg : str = None,
+                 metrics : ArchiveMetrics = None, backend = None):
         """Initialize the ArchiveObject storage container for managing files (and their component blobs) in an object store.
         This class uses the 'multicloud' store context to handle file storage and retrieval.
 
         Args:
             config (ArchiveConfig): The configuration object for the archive.
+            known_hashes (set): Hashes of blobs already present in the object store.  The set is shared with
+                the caller and extended with each blob once it is stored, so that duplicate content is only
+                uploaded once.
+            data (ArchiveData): The index database, used to locate blobs stored in packs.
+            hashalg (str): The content hash algorithm of the archive.  Defaults to the configured 'hash'.
+            metrics (ArchiveMetrics): Where the bytes and blobs transferred and the latencies of hashing, storing and
+                reading blobs are recorded.
+            backend: An object store to use instead of the configured multicloud context, with the same
+                object(path) interface, such as the in-memory store of the benchmarks.
         """
         self.config = config
         if self.config.debug:
             print("ArchiveObject:objectstore:",config.objectstore)
-        self.backend = MultiCloudContext('objectstore', config.objectstore) # todo: replace with multicloud context
+        if backend is not None:
+            self.backend = backend
+        else:
+            self.backend = MultiCloudContext('objectstore', config.objectstore) # todo: replace with multicloud context
+        self.metrics = metrics if metrics is not None else ArchiveMetrics()
+        self.store = ArchiveStore(self.backend, config.connections, config.retries, config.retrydelay,
+                                  metrics=self.metrics)
         self.verify_reads = self.config.verifyreads
+        self.chunker = make_chunker(self.config)
+        self.hashalg = hashalg if hashalg is not None else config.hashalg
+        self.hasher = make_hasher(self.hashalg)
+        self.probe_backend = self.config.probebackend
+        self.known_hashes = known_hashes if known_hashes is not None else set()
+        self.codec = ArchiveCodec(config.compression, config.compressionlevel)
+        self.uploaded = []     # (hash, size) of the objects uploaded, not yet returned by take_uploaded()
+        self.lock = threading.Lock()  # guards known_hashes and inflight when storing from worker threads
+        self.inflight = {}     # hash -> (Future, size, time claimed) of a blob claimed by a thread, until it is stored
+        self.data = data
+        self.packer = ArchivePacker(self, config.packsize) if config.packing else None
+        self.pack_threshold = config.packthreshold
+        self.last_pack = (None, None)  # (hash, contents) of the most recently read pack
+        self.cache = ArchiveCache(config.cachedir, config.cachesize, self.hasher) if config.cachedir else None
+
+    @property
+    def bytes_uploaded(self) -> int:
+        return self.metrics.get('bytes_uploaded')
+
+    @property
+    def bytes_deduped(self) -> int:
+        return self.metrics.get('bytes_deduped')
+
+    @property
+    def bytes_stored(self) -> int:
+        """Bytes written to the object store after compression."""
+        return self.metrics.get('bytes_stored')
 
     @classmethod
     def hashpath(cls, hash):
         path = f"{hash[0:2]}/{hash[2:4]}/{hash[4:6]}/{hash[6:8]}/{hash}"
         return path
 
+    def has_blob(self, hash : str) -> bool:
+        """Returns True if a blob with the given hash is known to be stored.  See has_blobs()."""
+        return hash in self.has_blobs([hash])
+
+    def has_blobs(self, hashes : Iterable[str]) -> set:
+        """Returns those of the given hashes whose blobs are known to be stored.
+
+        The shared set of known hashes is consulted first.  If 'probebackend' is configured, blobs that
+        are not known locally are looked up in the object store as well, with one batch of requests, and
+        those found are added to the known hashes.
+        """
+        found = set()
+        unknown = []
+        for h in hashes:
+            if h in self.known_hashes:
+                found.add(h)
+            else:
+                unknown.append(h)
+        if self.probe_backend and len(unknown) > 0:
+            exists = self.store.exists_many(self.hashpath(h) for h in unknown)
+            stored = [h for h in unknown if exists[self.hashpath(h)]]
+            with self.lock:
+                self.known_hashes.update(stored)
+            found.update(stored)
+        return found
+
+    def hash_blob(self, blob : bytes) -> str:
+        """Returns the content hash that identifies a blob."""
+        t0 = time.perf_counter()
+        h = self.hasher(blob)
+        self.metrics.observe('hash', time.perf_counter() - t0)
+        self.metrics.add('bytes_hashed', len(blob))
+        self.metrics.add('blobs_hashed')
+        return h
+
+    def store_blob(self, hash : str, blob : bytes) -> bool:
+        """Stores a blob under its precomputed hash unless it is already stored, and waits until it is.  Safe to call
+        from worker threads.
+
+        Args:
+            hash (str): The hash of the blob, as returned by hash_blob().
+            blob (bytes): The blob of data to store.
+
+        Returns:
+            bool: True if the blob was uploaded, False if it was deduplicated or added to a pack.
+        """
+        stored, data = self.claim_blob(hash, blob)
+        if data is not None:
+            try:
+                self._put(hash, data)
+            except BaseException as e:
+                self.settle_blob(hash, e)
+                raise
+            self.settle_blob(hash)
+        stored.result()
+        return data is not None
+
+    def claim_blob(self, hash : str, blob : bytes) -> tuple:
+        """Starts storing a blob under its precomputed hash unless it is already stored.  Safe to call from worker
+        threads.
+
+        A blob that is stored, or being stored by another thread, is deduplicated.  Otherwise the hash is claimed, so
+        that concurrent stores of the same content upload it only once, and the blob is added to the open pack if
+        it is small and packing is enabled, or encoded for upload.  An encoded blob must then be uploaded by the
+        caller, with upload_blobs(), and its claim settled.
+
+        Args:
+            hash (str): The hash of the blob, as returned by hash_blob().
+            blob (bytes): The blob of data to store.  Not referenced once the call returns.
+
+        Returns:
+            tuple: (future, data), where the future resolves to the hash once the blob is stored, and fails if it
+                could not be, and data is the encoded blob to upload, or None if there is nothing to upload.
+        """
+        t0 = time.perf_counter()
+        if not self.has_blob(hash):
+            with self.lock:
+                pending = self.inflight.get(hash)
+                claimed = pending is None and hash not in self.known_hashes
+                if claimed:
+                    stored = Future()
+                    self.inflight[hash] = (stored, len(blob), t0)
+            if claimed:
+                try:
+                    if self.packer is not None and len(blob) < self.pack_threshold:
+                        self.packer.add(hash, blob)
+                        data = None
+                    else:
+                        data = self.encode_blob(blob)
+                except BaseException as e:
+                    self.settle_blob(hash, e)
+                    raise
+                if data is None:
+                    self.settle_blob(hash)
+                return stored, data
+            if pending is not None:
+                # a duplicate of a blob being uploaded by another thread is only stored once that upload succeeds,
+                # and fails with it, so that no entry references a blob that was never stored
+                self.metrics.add('bytes_deduped', len(blob))
+                return pending[0], None
+        self.metrics.add('bytes_deduped', len(blob))
+        self.metrics.observe('put_blob', time.perf_counter() - t0)
+        stored = Future()
+        stored.set_result(hash)
+        return stored, None
+
+    def settle_blob(self, hash : str, error : BaseException = None):
+        """Ends the claim of a blob, once it is stored, or with the error that kept it from being stored."""
+        with self.lock:
+            stored, size, t0 = self.inflight.pop(hash)
+            if error is None:
+                self.known_hashes.add(hash)
+        if error is not None:
+            stored.set_exception(error)
+            return
+        self.metrics.add('bytes_uploaded', size)
+        self.metrics.observe('put_blob', time.perf_counter() - t0)
+        stored.set_result(hash)
+
+    def upload_blobs(self, items : Iterable[tuple]) -> Iterator[tuple]:
+        """Uploads blobs claimed with claim_blob() as one batch of object store requests, settling each claim as its
+        upload completes.
+
+        Args:
+            items (Iterable[tuple]): The (hash, data) of each blob, with the data returned by claim_blob().  Consumed
+                lazily.
+
+        Yields:
+            tuple: (hash, error) for each blob in order of completion, with None as the error if it was stored.
+        """
+        started = {}    # path -> (hash, size, time the request was queued)
+
+        def requests():
+            for h, data in items:
+                path = self.hashpath(h)
+                started[path] = (h, len(data), time.perf_counter())
+                yield path, data
+
+        for path, error in self.store.put_many(requests()):
+            h, size, t0 = started.pop(path)
+            if error is None:
+                self.metrics.observe('upload', time.perf_counter() - t0)
+                self._uploaded(h, size)
+            self.settle_blob(h, error)
+            yield h, error
+
+    def forget(self, hashes : list):
+        """Removes blobs that could not be stored after all, such as the members of a pack whose upload failed,
+        from the known hashes.
+        """
+        with self.lock:
+            for h in hashes:
+                self.known_hashes.discard(h)
+
+    def encode_blob(self, blob : bytes) -> bytes:
+        """Returns a blob as it is uploaded, compressed if compression is configured."""
+        data = self.codec.encode(blob)
+        if not isinstance(data, bytes):
+            # object store backends take bytes; only blobs that are actually uploaded are copied out of the
+            # chunk buffer
+            data = bytes(data)
+        return data
+
+    def upload_blob(self, hash : str, blob : bytes):
+        """Uploads a blob to its hash path in the object store, compressed if compression is configured."""
+        self._put(hash, self.encode_blob(blob))
+
+    def _put(self, hash : str, data : bytes):
+        with self.metrics.timer('upload'):
+            self.store.put(self.hashpath(hash), data)
+        self._uploaded(hash, len(data))
+
+    def _uploaded(self, hash : str, size : int):
+        self.metrics.add('bytes_stored', size)
+        with self.lock:
+            self.uploaded.append((hash, size))
+
+    def flush_packs(self) -> list:
+        """Uploads the open pack, if packing is enabled.
+
+        Returns:
+            list: The (hash, pack, offset, length) locations of the blobs packed since the last flush, to be
+                written with ArchiveData.write_packed() before the entries referencing them are committed.
+        """
+        return self.packer.flush() if self.packer is not None else []
+
+    def take_uploaded(self) -> list:
+        """Returns the (hash, size) of the objects uploaded since the last call, to be recorded with
+        ArchiveData.write_stored() for garbage collection.
+        """
+        with self.lock:
+            uploaded, self.uploaded = self.uploaded, []
+        return uploaded
+
+    def locate(self, hash : str) -> tuple:
+        """Returns the (pack, offset, length) location of a packed blob, or None if the blob is stored on its own."""
+        return self.data.read_packed(hash) if self.data is not None else None
+
     def put_blob(self, blob : bytes) -> str:
         """
-        Stores a blob of data in the object store and return its hash.  If the blob already exists, it rewrites the existing blob.
+        Stores a blob of data in the object store and return its hash.  If the blob already exists, the upload is
+        skipped and the blob is counted as deduplicated.
 
         Args:
             blob (bytes): The blob of data to store.
@@ -45,78 +293,145 @@ class ArchiveObject:
         Returns:
             str: The hash of the stored blob.
         """
-        hash = base64.b16encode(md5(blob).digest()).decode('ASCII')
-        o = self.backend.object(self.hashpath(hash))
-        o.put_bytes(blob)
+        hash = self.hash_blob(blob)
+        self.store_blob(hash, blob)
         return hash
 
-    def get_blob(self, hash : str):
-        o = self.backend.object(self.hashpath(hash))
-        buf = o.get_bytes()
+    def get_blob(self, hash : str, cached : bool = True):
+        """Returns the contents of a blob, read from its pack if it is packed.
+
+        If 'cachedir' is configured, blobs and packs are served from the local cache when present there, and
+        added to it when read from the object store.
+
+        Args:
+            hash (str): The hash of the blob.
+            cached (bool): If False, always read from the object store and leave the cache as is.
+        """
+        loc = self.locate(hash)
+        if loc is not None:
+            pack, offset, length = loc
+            return self.get_pack(pack, cached)[offset:offset+length]
+        with self.metrics.timer('get_blob'):
+            return self._get_blob(hash, self.cache if cached else None)
+
+    def get_blobs(self, hashes : Iterable[str], then, queued : int = None) -> Iterator[tuple]:
+        """Reads blobs stored on their own, or packs, with one batch of object store requests.
+
+        Each blob is served from the local cache if it is there, as with get_blob(), and handed to then() on the
+        thread that read it, so that it can be written out without being held until it is yielded.
+
+        Args:
+            hashes (Iterable[str]): The hashes of the blobs or packs.  Consumed lazily.
+            then (callable): Called with (hash, contents) of each blob once it is read.
+            queued (int): The maximum number of blobs requested and not yet yielded.
+
+        Yields:
+            tuple: (hash, result, error) for each blob in order of completion, with what then() returned as the
+                result, and None as the error if it was read.
+        """
+        def read(path):
+            h = path[path.rfind("/")+1:]
+            with self.metrics.timer('get_blob'):
+                buf = self._get_blob(h, self.cache)
+            return then(h, buf)
+
+        for path, result, error in self.store.get_many(map(self.hashpath, hashes), read, queued):
+            yield path[path.rfind("/")+1:], result, error
+
+    def _get_blob(self, hash : str, cache : ArchiveCache):
+        if cache is not None:
+            buf = cache.get(hash)
+            if buf is not None:
+                self.metrics.add('bytes_cached', len(buf))
+                return buf
+        data = self.store.get(self.hashpath(hash))
+        self.metrics.add('bytes_downloaded', len(data))
+        self.metrics.add('blobs_downloaded')
+        buf = self.codec.decode(data)
         if self.verify_reads:
-            success = (base64.b16encode(md5(buf)) == hash)
+            success = (self.hash_blob(buf) == hash)
             assert(success)
+        if cache is not None:
+            cache.put(hash, buf)
         return buf
 
-    def put_file(self, archive_id, path) -> ArchiveEntry:
+    def get_pack(self, pack : str, cached : bool = True) -> bytes:
+        """Returns the contents of a pack, reusing the most recently read pack so that neighbouring blobs are read
+        with a single request.
+        """
+        with self.lock:
+            last_hash, last_buf = self.last_pack
+        if last_hash == pack:
+            return last_buf
+        buf = self.get_blob(pack, cached)
+        with self.lock:
+            self.last_pack = (pack, buf)
+        return buf
+
+    def libpath(self, path) -> str:
+        """Returns the normalized library path of a file in the local mirror."""
         basedir = os.path.join(self.config.localmirror, ".")[:-1]
         assert(path.startswith(basedir))
-        libpath = path.replace(basedir, "").replace("\\", "/") #normalize path
+        return path.replace(basedir, "").replace("\\", "/") #normalize path
+
+    def localpath(self, libpath : str) -> str:
+        """Returns the path of a library file in the local mirror."""
+        basedir = os.path.join(self.config.localmirror, ".")[:-1]
+        path = libpath
+        if sys.platform.startswith("win"):
+            path = path.replace("/", "\\")
+        return os.path.join(basedir, path)
+
+    def put_file(self, archive_id, path) -> ArchiveEntry:
+        libpath = self.libpath(path)
         hashlist = []
+        partsizes = []
         with open(path, "rb") as f:
-            f_size = os.fstat(f.fileno()).st_size
-            for begin in range(0, f_size, MAXBLOB):
-                buf = f.read(MAXBLOB)
+            st = os.fstat(f.fileno())
+            for buf in self.chunker.chunks(f):
                 h = self.put_blob(buf)
                 hashlist.append(h)
-        return ArchiveEntry(archive_id, libpath, hashlist, f_size)
+                partsizes.append(len(buf))
+        entry = ArchiveEntry(archive_id, libpath, hashlist, 0, partsizes=partsizes)
+        entry.set_stat(st)
+        entry.size = sum(partsizes)
+        return entry
     
     def verify_file(self, archive_entry : ArchiveEntry):
-        basedir = os.path.join(self.config.localmirror, ".")[:-1]
-        path = archive_entry.libpath
-        if sys.platform.startswith("win"):
-            path = path.replace("/", "\\")
-        path = os.path.join(basedir, path)
-        total_size = 0
-        with open(path, "rb") as f:
-            if archive_entry.size == 0:
-                if os.path.isfile(path) and os.fstat(f.fileno()).st_size == 0:
-                    return True
-                print(f"Size mismatch {path} expected 0 got non-zero")
-                return False
-            nparts = (archive_entry.size // MAXBLOB)+1
-            for part in range(0, nparts):
-                buf = f.read(MAXBLOB)
-                if part < nparts-1:
-                    # catch out of order parts, shouldn't happen
-                    assert(len(buf) == MAXBLOB)
-                h = base64.b16encode(md5(buf).digest()).decode('ASCII')
-                if h != archive_entry.hashlist[part]:
-                    print(f"Hash mismatch {path} part {part} expected {archive_entry.hashlist[part]} got {h}")
-                    return False
-                total_size += len(buf)
-        if archive_entry.size != total_size:
-            print(f"Size mismatch {path} expected {archive_entry.size} got {total_size}")
-            return False
-        return True
+        """Rehashes the local copy of an entry, printing the first difference found.
+
+        Returns:
+            bool: True if the local file matches the entry.
+        """
+        msg = check_file(self.localpath(archive_entry.libpath), archive_entry.size, list(archive_entry.parts()),
+                         self.hashalg)
+        if msg is not None:
+            print(msg)
+        return msg is None
+
+    def open_entry(self, entry : ArchiveEntry, readahead : bool = True) -> ArchiveReader:
+        """Opens an archived file for reading straight from the object store, without restoring it.
+
+        Args:
+            entry (ArchiveEntry): The entry to read.
+            readahead (bool): If True, fetch the next part in the background during sequential reads.
+
+        Returns:
+            ArchiveReader: A seekable binary file object that fetches only the parts covering the bytes read.
+        """
+        return ArchiveReader(self, entry, readahead)
 
     def get_file(self, library_entry : ArchiveEntry):
-        basedir = os.path.join(self.config.localmirror, ".")[:-1]
-        path = library_entry.libpath
-        if sys.platform.startswith("win"):
-            path = path.replace("/", "\\")
-        path = os.path.join(basedir, path)
+        path = self.localpath(library_entry.libpath)
         total_size = 0
         os.makedirs(os.path.dirname(path), exist_ok=True)
         with open(path, "wb") as f:
             if library_entry.size == 0:
                 return
-            nparts = (library_entry.size // MAXBLOB)+1
-            for part in range(0, nparts):
-                buf = self.get_blob(library_entry.hashlist[part])
-                if part < nparts-1:
-                    # catch out of order parts, shouldn't happen
-                    assert(len(buf) == MAXBLOB)
+            for part, h, offset, length in library_entry.parts():
+                buf = self.get_blob(h)
+                # catch truncated or out of order parts, shouldn't happen
+                assert(len(buf) == length)
                 f.write(buf)
                 total_size += len(buf)
         assert(library_entry.size == total_size)
@@ -0,0 +1,87 @@
+import threading
+from typing import List
+
+
+class ArchivePacker:
+    def __init__(self, objects, packsize : int):
+        """Aggregates small blobs into pack objects to cut per-object overhead in the object store.
+
+        Blobs are appended to an open pack until it reaches packsize bytes; the pack is then stored as an ordinary
+        blob under the hash of its contents.  The location of each packed blob is recorded as a
+        (hash, pack, offset, length) row that must be written to the PackedBlobs table, in the same transaction as
+        the entries that reference the blob, after flush() has returned it.  If a pack fails to upload, its blobs
+        are forgotten and the next flush() raises the error, so the entries referencing them are not committed.
+
+        Args:
+            objects (ArchiveObject): The object store the packs are uploaded to.
+            packsize (int): The size at which a pack is closed and uploaded.
+        """
+        self.objects = objects
+        self.packsize = packsize
+        self.lock = threading.Condition()
+        self.buf = bytearray()
+        self.members = []     # (hash, offset, length) of the blobs in the open pack
+        self.located = []     # (hash, pack, offset, length) of blobs in uploaded packs, not yet returned by flush()
+        self.uploading = 0    # number of packs being uploaded by other threads
+        self.error = None     # the first failed pack upload, raised by flush()
+
+    def add(self, hash : str, blob : bytes):
+        """Append a blob to the open pack, uploading the pack if it is full.  Safe to call from worker threads."""
+        with self.lock:
+            self.members.append((hash, len(self.buf), len(blob)))
+            self.buf += blob
+            if len(self.buf) < self.packsize:
+                return
+            buf, members = self._take()
+        self._upload(buf, members)
+
+    def _take(self) -> tuple:
+        buf, members = bytes(self.buf), self.members
+        self.buf = bytearray()
+        self.members = []
+        self.uploading += 1
+        return buf, members
+
+    def _upload(self, buf : bytes, members : list):
+        try:
+            if len(members) == 1:
+                # a pack of one blob would have the blob's own hash, so store the blob on its own instead
+                self.objects.upload_blob(members[0][0], buf)
+                return
+            pack = self.objects.hash_blob(buf)
+            self.objects.upload_blob(pack, buf)
+            with self.lock:
+                self.located.extend((h, pack, offset, length) for h, offset, length in members)
+        except BaseException as e:
+            self.objects.forget([h for h, _offset, _length in members])
+            with self.lock:
+                self.error = self.error if self.error is not None else e
+            raise
+        finally:
+            with self.lock:
+                self.uploading -= 1
+                self.lock.notify_all()
+
+    def flush(self) -> List[tuple]:
+        """Upload the open pack and wait for packs being uploaded by other threads.
+
+        Returns:
+            List[tuple]: The (hash, pack, offset, length) rows of the blobs packed since the last flush.
+
+        Raises:
+            Exception: The error of a pack that failed to upload.
+        """
+        with self.lock:
+            if len(self.members) > 0:
+                buf, members = self._take()
+            else:
+                buf = None
+        if buf is not None:
+            self._upload(buf, members)
+        with self.lock:
+            while self.uploading > 0:
+                self.lock.wait()
+            if self.error is not None:
+                raise self.error
+            located, self.located = self.located, []
+        return located
@@ -0,0 +1,60 @@
+import fnmatch
+import re
+from typing import List
+
+class ArchivePattern:
+    def __init__(self, pattern : str):
+        """A shell-style pattern compiled once for matching library paths.
+
+        Besides the compiled matcher, the pattern is split into the literal prefix that every match starts with,
+        which can be turned into an indexed range query, and the literal runs that every match contains, which
+        can be looked up in a substring index.  Matching is case sensitive.
+
+        Args:
+            pattern (str): An fnmatch pattern.  None or "" matches everything.
+        """
+        self.pattern = pattern if pattern else "*"
+        self.regex = re.compile(fnmatch.translate(self.pattern))
+        self.literals = self.literal_runs(self.pattern)
+        self.prefix = self.literals[0]
+
+    @classmethod
+    def literal_runs(cls, pattern : str) -> List[str]:
+        """Split a pattern into the runs of literal characters between its wildcards, following the bracket
+        parsing rules of fnmatch.translate.
+        """
+        runs = [""]
+        i, n = 0, len(pattern)
+        while i < n:
+            c = pattern[i]
+            i += 1
+            if c in "*?":
+                runs.append("")
+            elif c == "[":
+                j = i
+                if j < n and pattern[j] == "!":
+                    j += 1
+                if j < n and pattern[j] == "]":
+                    j += 1
+                while j < n and pattern[j] != "]":
+                    j += 1
+                if j >= n:
+                    runs[-1] += c   # unterminated bracket matches a literal '['
+                else:
+                    runs.append("")
+                    i = j + 1
+            else:
+                runs[-1] += c
+        return runs
+
+    @property
+    def literal(self) -> str:
+        """The longest literal run of the pattern."""
+        return max(self.literals, key=len)
+
+    @property
+    def matches_all(self) -> bool:
+        return self.pattern == "*"
+
+    def match(self, libpath : str) -> bool:
+        return self.regex.match(libpath) is not None
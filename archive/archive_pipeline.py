@@ -0,0 +1,273 @@
+from concurrent.futures import ThreadPoolExecutor, Future
+from collections import deque
+from typing import Iterable, Iterator, List
+import os
+import queue
+import threading
+from .archive_object import ArchiveObject
+from .archive_entry import ArchiveEntry
+from .archive_chunker import BufferPool
+
+
+class ArchivePipeline:
+    def __init__(self, objects : ArchiveObject, workers : int = 4, maxbuffers : int = 8, window : int = 1024):
+        """Initialize a pipelined backup and restore engine that overlaps disk I/O, hashing and transfers.
+
+        Files are read serially, one part at a time, by the calling thread, and split by the chunker of the
+        object store.  Each chunk is read with readinto() into one of maxbuffers reusable buffers and hashed
+        on a pool of hashing threads, which deduplicate it, add it to the open pack or encode it for upload.
+        The blobs to upload are streamed to a single batch of object store requests, ArchiveObject.upload_blobs(),
+        that runs for the whole backup on the store's connections, and each buffer goes back to the pool once
+        its chunk is stored.  hashlib releases the GIL while digesting large buffers, so threads are used rather
+        than processes, which would have to copy every chunk.
+
+        Restores fetch blobs with a single batch of object store requests, ArchiveObject.get_blobs(), reading
+        ahead up to maxbuffers blobs, and write each part at its offset in a preallocated file on the thread
+        that fetched it, so that parts can land in any order.  The entries to restore are listed a window of
+        about window parts at a time, so the memory used to plan the fetches does not grow with the number of
+        entries.
+
+        Peak memory during a backup is maxbuffers chunk buffers, each the size of its part rounded up to a
+        power of two and at most the chunker's maximum part size (MAXBLOB, or chunkmax with content-defined
+        chunking), plus a 2 * chunkmax read window for content-defined chunking, plus one compressed or copied
+        blob for each chunk waiting to be uploaded, plus the open pack when packing is enabled.  During a
+        restore it is about maxbuffers stored blobs or packs.
+
+        Args:
+            objects (ArchiveObject): The object store used to store the blobs.
+            workers (int): The number of hashing threads.
+            maxbuffers (int): The maximum number of chunks held in memory at once.
+            window (int): The number of parts of the entries listed ahead of the fetches during a restore.
+        """
+        assert(maxbuffers > 0)
+        self.objects = objects
+        self.workers = workers
+        self.pool = BufferPool(maxbuffers, objects.chunker.maxsize)
+        self.maxbuffers = maxbuffers
+        self.window = window
+        self.hashers = None
+        self.uploads = None     # (hash, data) of the blobs to upload, then None
+        self.held = {}          # hash -> buffer of a blob being uploaded
+
+    def _hash(self, buf : memoryview) -> Future:
+        try:
+            h = self.objects.hash_blob(buf)
+            stored, data = self.objects.claim_blob(h, buf)
+        except BaseException:
+            self.pool.release(buf)
+            raise
+        if data is None:
+            self.pool.release(buf)
+        else:
+            # the buffer is held until the blob is uploaded, which bounds the blobs waiting for upload
+            self.held[h] = buf
+            self.uploads.put((h, data))
+        return stored
+
+    def _upload(self):
+        """Uploads the blobs queued by the hashing threads, returning each buffer to the pool once its upload is done."""
+        for h, _error in self.objects.upload_blobs(iter(self.uploads.get, None)):
+            self.pool.release(self.held.pop(h))
+
+    def _read_file(self, archive_id, path, on_chunk=None) -> tuple:
+        libpath = self.objects.libpath(path)
+        parts : List[Future] = []
+        partsizes = []
+        with open(path, "rb") as f:
+            st = os.fstat(f.fileno())
+            # blocks while all buffers are in flight
+            for buf in self.objects.chunker.chunks(f, self.pool):
+                parts.append(self.hashers.submit(self._hash, buf))
+                partsizes.append(len(buf))
+                self.objects.metrics.add('bytes_read', len(buf))
+                if on_chunk is not None:
+                    on_chunk()
+        entry = ArchiveEntry(archive_id, libpath, [], 0, partsizes=partsizes)
+        entry.set_stat(st)
+        entry.size = sum(partsizes)
+        return entry, parts
+
+    @classmethod
+    def _drain(cls, pending : deque, block : bool) -> Iterator[ArchiveEntry]:
+        """Yields the completed files at the head of the pending queue, in the order they were read."""
+        while pending:
+            entry, parts = pending[0]
+            if not block and not all(p.done() and p.result().done() for p in parts):
+                return
+            entry.hashlist = [p.result().result() for p in parts]
+            pending.popleft()
+            yield entry
+
+    def put_files(self, archive_id, paths : Iterable[str], on_chunk=None) -> Iterator[ArchiveEntry]:
+        """Stores the given files and yields an entry for each one once all of its parts are stored.
+
+        Entries are yielded in the same order as the input paths, and each entry's hash list is in
+        part order, so the caller can write them to the index as they arrive.  A part that duplicates a
+        blob another file is still uploading only completes once that upload succeeds, and fails with it,
+        so an entry is never yielded before the blobs it references are stored.  Uploads run on a thread of
+        their own, which is done by the time the last entry is yielded.
+
+        Args:
+            archive_id (int): The archive the entries belong to.
+            paths (Iterable[str]): Paths of files in the local mirror.  Consumed lazily.
+            on_chunk (callable): Called in the calling thread after each chunk is read, so that the caller can
+                checkpoint its progress while a large file is being stored.
+
+        Yields:
+            ArchiveEntry: The entry for each stored file, with its hash list and stat cache filled in.
+        """
+        pending = deque()
+        self.uploads = queue.SimpleQueue()
+        uploader = threading.Thread(target=self._upload)
+        uploader.start()
+        try:
+            with ThreadPoolExecutor(self.workers) as self.hashers:
+                for path in paths:
+                    pending.append(self._read_file(archive_id, path, on_chunk))
+                    yield from self._drain(pending, block=False)
+            # the hashing threads are done, so nothing more is queued
+            self.uploads.put(None)
+            yield from self._drain(pending, block=True)
+        finally:
+            # a second end marker is never read
+            self.uploads.put(None)
+            uploader.join()
+
+    @classmethod
+    def _write_at(cls, path : str, offset : int, buf : bytes):
+        """Writes a buffer at the given offset of an existing file."""
+        fd = os.open(path, os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+        try:
+            view = memoryview(buf)
+            while len(view) > 0:
+                if hasattr(os, 'pwrite'):
+                    n = os.pwrite(fd, view, offset)
+                else:
+                    os.lseek(fd, offset, os.SEEK_SET)
+                    n = os.write(fd, view)
+                view = view[n:]
+                offset += n
+        finally:
+            os.close(fd)
+
+    def _write(self, members : list, buf) -> list:
+        """Writes the blobs read from one stored blob or pack at every offset where they occur, returning the writes."""
+        buf = memoryview(buf)
+        written = []
+        for h, loc, writes in members:
+            blob = buf[loc[1]:loc[1]+loc[2]] if loc is not None else buf
+            for entry, part, path, offset, length in writes:
+                # catch truncated or out of order parts, shouldn't happen
+                assert(len(blob) == length)
+                self._write_at(path, offset, blob)
+                self.objects.metrics.add('bytes_written', length)
+            written.extend(writes)
+        return written
+
+    def _windows(self, entries : Iterable[ArchiveEntry]) -> Iterator[List[ArchiveEntry]]:
+        """Splits the entries into lists of about self.window parts, consuming them lazily."""
+        window = []
+        nparts = 0
+        for entry in entries:
+            window.append(entry)
+            nparts += max(1, len(entry.hashlist))
+            if nparts >= self.window:
+                yield window
+                window = []
+                nparts = 0
+        if len(window) > 0:
+            yield window
+
+    def get_files(self, entries : Iterable[ArchiveEntry], written=None, on_written=None) -> Iterator[ArchiveEntry]:
+        """Restores the given entries to the local mirror and yields each entry once all of its parts are written.
+
+        Entries are consumed a window of about self.window parts at a time, on the thread that issues the fetches.
+        Every file of a window is created at its full size, and each distinct blob of the window is fetched exactly
+        once, even when it is shared by several entries or parts, and written at every offset where it occurs.
+        Blobs stored in the same pack are all served by a single read of the pack.  Blobs are fetched in the order
+        they are first referenced, so files near the start of the list complete first.  All the fetches go through
+        one batch of object store requests, so those of a window are queued while those of the previous window are
+        still running, and the transfers do not pause between windows.  A blob shared with another window is
+        fetched again, from the local blob cache if one is configured.
+
+        Args:
+            entries (Iterable[ArchiveEntry]): The entries to restore.  Consumed lazily, on another thread.
+            written (callable): Returns the set of part numbers of an entry already written to the local file by
+                an interrupted restore.  Those parts are kept and not fetched again.  Called on another thread.
+            on_written (callable): Called in the calling thread with (entry, part) for each part written.
+
+        Yields:
+            ArchiveEntry: Each restored entry, in order of completion.
+        """
+        remaining = {}  # id(entry) -> number of parts not yet written
+        ready = deque() # entries with nothing left to fetch, yielded with the next completed fetch
+        fetching = {}   # pack or hash -> deque of the [(hash, location in pack, writes)] of each queued fetch
+        lock = threading.Lock()
+        error = None
+
+        def fetches():
+            for window in self._windows(entries):
+                targets = {}    # hash -> [(entry, part, path, offset, length)]
+                for entry in window:
+                    path = self.objects.localpath(entry.libpath)
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    done = written(entry) if written is not None and os.path.isfile(path) else set()
+                    with open(path, "r+b" if len(done) > 0 else "wb") as f:
+                        f.truncate(entry.size)
+                    todo = [p for p in entry.parts() if p[0] not in done]
+                    if len(done) > 0:
+                        self.objects.metrics.add('bytes_resumed', sum(p[3] for p in entry.parts() if p[0] in done))
+                    if len(todo) == 0:
+                        ready.append(entry)
+                        continue
+                    remaining[id(entry)] = len(todo)
+                    for part, h, offset, length in todo:
+                        if h not in targets:
+                            targets[h] = []
+                        targets[h].append((entry, part, path, offset, length))
+
+                # group the blobs by the object they are read from: their pack, or the blob itself
+                members = {}    # pack or hash -> [(hash, location in pack, writes)]
+                for h, writes in targets.items():
+                    loc = self.objects.locate(h)
+                    key = loc[0] if loc is not None else h
+                    if key not in members:
+                        members[key] = []
+                    members[key].append((h, loc, writes))
+
+                for key in members:
+                    if error is not None:
+                        return
+                    with lock:
+                        if key not in fetching:
+                            fetching[key] = deque()
+                        fetching[key].append(members[key])
+                    yield key
+
+        def write(key, buf):
+            # fetches of the same object in flight at once are interchangeable, so each takes the oldest writes
+            with lock:
+                queued = fetching[key]
+                members = queued.popleft()
+                if len(queued) == 0:
+                    del fetching[key]
+            return self._write(members, buf)
+
+        for _key, writes, e in self.objects.get_blobs(fetches(), write, self.maxbuffers):
+            while ready:
+                yield ready.popleft()
+            if e is not None:
+                # keep the parts written by the other fetches, and raise once they are accounted for
+                error = error if error is not None else e
+                continue
+            for entry, part, _path, _offset, _length in writes:
+                if on_written is not None:
+                    on_written(entry, part)
+                remaining[id(entry)] -= 1
+                if remaining[id(entry)] == 0:
+                    del remaining[id(entry)]
+                    yield entry
+        while ready:
+            yield ready.popleft()
+        if error is not None:
+            raise error
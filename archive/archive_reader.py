@@ -0,0 +1,123 @@
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
+import io
+from .archive_entry import ArchiveEntry
+
+
+class ArchiveReader(io.RawIOBase):
+    def __init__(self, objects, entry : ArchiveEntry, readahead : bool = True):
+        """A read-only, seekable file object over the contents of an archived file, read from the object store.
+
+        Only the parts that cover the bytes read are fetched, one part at a time, so reading a range of a large
+        file costs at most the parts it spans.  The current part is kept in memory until a read moves past it.
+        With readahead, once reads move on from a part to the next one, the part after it is fetched on a
+        background thread while the current one is read, so a sequential read overlaps the transfers with the
+        consumer, and random reads fetch nothing ahead.  Memory use is at most two parts.
+
+        Args:
+            objects (ArchiveObject): The object store holding the parts.
+            entry (ArchiveEntry): The entry to read.
+            readahead (bool): If True, fetch the next part in the background.
+        """
+        super().__init__()
+        self.objects = objects
+        self.entry = entry
+        self.parts = list(entry.parts())
+        self.offsets = [offset for _part, _h, offset, _length in self.parts]
+        self.size = entry.size
+        self.pos = 0
+        self.current = (None, None)   # (index, contents) of the part in memory
+        self.prefetch = (None, None)  # (index, future) of the part being fetched ahead
+        self.pool = ThreadPoolExecutor(1) if readahead and len(self.parts) > 1 else None
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.pos
+
+    def seek(self, offset : int, whence : int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self.pos + offset
+        elif whence == io.SEEK_END:
+            pos = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence {whence}")
+        if pos < 0:
+            raise ValueError(f"Negative seek position {pos}")
+        self.pos = pos
+        return pos
+
+    def _fetch(self, i : int) -> memoryview:
+        part, h, _offset, length = self.parts[i]
+        buf = self.objects.get_blob(h)
+        if len(buf) != length:
+            raise IOError(f"Part {part} of {self.entry.libpath} is {len(buf)} bytes, expected {length}")
+        return memoryview(buf)
+
+    def _part(self, i : int) -> memoryview:
+        """Returns the contents of part i, starting a fetch of the part after it if reads are sequential."""
+        index, buf = self.current
+        if index == i:
+            return buf
+        sequential = index == i - 1 or (index is None and self.pos == 0)
+        index, future = self.prefetch
+        self.prefetch = (None, None)
+        if index == i:
+            buf = future.result()
+        else:
+            if future is not None:
+                future.cancel()
+            buf = self._fetch(i)
+        self.current = (i, buf)
+        if self.pool is not None and sequential and i + 1 < len(self.parts):
+            self.prefetch = (i + 1, self.pool.submit(self._fetch, i + 1))
+        return buf
+
+    def readinto(self, b) -> int:
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        if self.pos >= self.size:
+            return 0
+        i = bisect_right(self.offsets, self.pos) - 1
+        buf = self._part(i)
+        start = self.pos - self.offsets[i]
+        view = memoryview(b).cast("B")
+        n = min(len(view), len(buf) - start)
+        view[:n] = buf[start:start+n]
+        self.pos += n
+        return n
+
+    def read(self, size : int = -1) -> bytes:
+        """Reads up to size bytes, or to the end of the file if size is negative, in as few calls as possible."""
+        remaining = max(0, self.size - self.pos)
+        size = remaining if size is None or size < 0 else min(size, remaining)
+        buf = bytearray(size)
+        view = memoryview(buf)
+        n = 0
+        while n < size:
+            k = self.readinto(view[n:])
+            if k == 0:
+                break
+            n += k
+        view.release()
+        return bytes(buf) if n == size else bytes(buf[:n])
+
+    def readall(self) -> bytes:
+        return self.read(-1)
+
+    def close(self):
+        if self.pool is not None:
+            _index, future = self.prefetch
+            if future is not None:
+                future.cancel()
+            self.pool.shutdown(wait=True)
+            self.pool = None
+        self.current = (None, None)
+        self.prefetch = (None, None)
+        super().close()
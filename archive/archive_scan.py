@@ -0,0 +1,167 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from typing import Iterable, Iterator, List
+import os
+import re
+
+
+class ExcludeRules:
+    def __init__(self, patterns : Iterable[str] = ()):
+        """Matches library paths against gitignore-style exclude patterns.
+
+        Supported syntax: blank lines and '#' comments are ignored; '*' and '?' match within a path component and
+        '[...]' matches a character class; '**' matches any number of directories; a trailing '/' only matches
+        directories; a pattern containing a '/' other than at its end is anchored at the mirror root, otherwise
+        it matches at any depth; a leading '!' re-includes paths excluded by an earlier pattern.  The last matching
+        pattern wins.  As with git, the contents of an excluded directory cannot be re-included.
+
+        Args:
+            patterns (Iterable[str]): The exclude patterns, in order.
+        """
+        self.rules = []  # (regex, dironly, negate)
+        for pattern in patterns:
+            pattern = pattern.strip()
+            if pattern == "" or pattern.startswith("#"):
+                continue
+            negate = pattern.startswith("!")
+            if negate:
+                pattern = pattern[1:]
+            dironly = pattern.endswith("/")
+            pattern = pattern.rstrip("/")
+            anchored = "/" in pattern
+            pattern = pattern.lstrip("/")
+            regex = ("^" if anchored else "^(?:.*/)?") + self._translate(pattern) + "$"
+            self.rules.append((re.compile(regex), dironly, negate))
+
+    @classmethod
+    def _translate(cls, pattern : str) -> str:
+        """Returns the regular expression for the body of a pattern."""
+        out = []
+        i = 0
+        n = len(pattern)
+        while i < n:
+            c = pattern[i]
+            if pattern.startswith("**/", i):
+                out.append("(?:.*/)?")
+                i += 3
+            elif pattern.startswith("**", i):
+                out.append(".*")
+                i += 2
+            elif c == "*":
+                out.append("[^/]*")
+                i += 1
+            elif c == "?":
+                out.append("[^/]")
+                i += 1
+            elif c == "[" and pattern.find("]", i + 2) >= 0:
+                j = pattern.find("]", i + 2)
+                body = pattern[i+1:j]
+                if body.startswith("!"):
+                    body = "^" + body[1:]
+                out.append("[" + body.replace("\\", "\\\\") + "]")
+                i = j + 1
+            else:
+                out.append(re.escape(c))
+                i += 1
+        return "".join(out)
+
+    def excluded(self, relpath : str, is_dir : bool) -> bool:
+        """Returns True if the path, relative to the mirror root with '/' separators, is excluded."""
+        result = False
+        for regex, dironly, negate in self.rules:
+            if dironly and not is_dir:
+                continue
+            if regex.match(relpath):
+                result = not negate
+        return result
+
+
+class ArchiveScanner:
+    def __init__(self, root : str, excludes : Iterable[str] = (), workers : int = 4):
+        """Initialize a scanner that lists the regular files of a directory tree with os.scandir.
+
+        Directories are listed on a pool of threads, each reading one directory at a time, so that the listings
+        of a large tree overlap.  Files are yielded as soon as their directory has been read, so that the caller
+        can start storing them before the walk finishes.  The order is breadth first, and sorted by name within
+        each directory, so it is the same on every run of an unchanged tree.  Excluded directories are not
+        entered.  Symbolic links to files are followed; symbolic links to directories are not.
+
+        Args:
+            root (str): The root directory, the local mirror.
+            excludes (Iterable[str]): gitignore-style exclude patterns, see ExcludeRules.
+            workers (int): The number of threads listing directories.
+        """
+        self.root = root
+        self.excludes = ExcludeRules(excludes)
+        self.workers = workers
+        self.ndirs = 0
+        self.nfiles = 0
+        self.nexcluded = 0
+        self.errors : List[tuple] = []  # (path, message) of the directories that could not be read
+        self.unread : List[str] = []  # library paths, ending in '/', of the directories that could not be read
+
+    def _scandir(self, path : str, relpath : str) -> tuple:
+        """Lists one directory.
+
+        Returns:
+            tuple(files, dirs, nexcluded): The (path, stat_result) of its regular files, the (path, relpath) of its
+                subdirectories, and the number of entries excluded.
+        """
+        files = []
+        dirs = []
+        nexcluded = 0
+        with os.scandir(path) as it:
+            for entry in it:
+                rel = relpath + entry.name
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if self.excludes.excluded(rel, True):
+                            nexcluded += 1
+                        else:
+                            dirs.append((entry.path, rel + "/"))
+                    elif entry.is_file():
+                        if self.excludes.excluded(rel, False):
+                            nexcluded += 1
+                        else:
+                            # the stat result is cached on the DirEntry, and free on Windows
+                            files.append((entry.path, entry.stat()))
+                except FileNotFoundError:
+                    # removed while the directory was being read
+                    continue
+        files.sort()
+        dirs.sort()
+        return files, dirs, nexcluded
+
+    def _scansubdir(self, path : str, relpath : str) -> tuple:
+        try:
+            return self._scandir(path, relpath)
+        except OSError as e:
+            self.errors.append((path, str(e)))
+            self.unread.append(relpath)
+            return [], [], 0
+
+    def scan(self) -> Iterator[tuple]:
+        """Walks the tree and yields (path, stat_result) for each regular file that is not excluded.
+
+        Subdirectories that cannot be read are skipped and recorded in errors and unread, so that the caller can
+        keep what it knows of their contents.
+
+        Raises:
+            OSError: If the root directory cannot be read.
+        """
+        pending = deque()
+        with ThreadPoolExecutor(self.workers) as pool:
+            try:
+                pending.append(pool.submit(self._scandir, self.root, ""))
+                while pending:
+                    files, dirs, nexcluded = pending.popleft().result()
+                    # queue the subdirectories first, so the threads keep listing while the files are consumed
+                    for path, relpath in dirs:
+                        pending.append(pool.submit(self._scansubdir, path, relpath))
+                    self.ndirs += 1
+                    self.nfiles += len(files)
+                    self.nexcluded += nexcluded
+                    yield from files
+            finally:
+                for future in pending:
+                    future.cancel()
@@ -0,0 +1,130 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Iterator
+import threading
+import time
+
+
+class BandwidthLimiter:
+    def __init__(self, rate : float):
+        """Spaces out transfers shared by several threads so that together they average at most rate bytes per
+        second.
+
+        Args:
+            rate (float): The bandwidth cap in bytes per second, or 0 for no cap.
+        """
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.next = time.monotonic()  # the time at which the bytes consumed so far have been paid for
+
+    def consume(self, nbytes : int):
+        """Account for a transfer of nbytes, sleeping until the transfers before it fit under the cap."""
+        if self.rate <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next)
+            self.next = start + nbytes / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+
+class ArchiveScrubber:
+    def __init__(self, objects, data, archive_id : int, workers : int = 4, rate : float = 0):
+        """Verifies the blobs stored in the object store by fetching them and recomputing their hashes.
+
+        Each run checks the blobs of the archive that have gone longest without a scrub, as recorded in the
+        ScrubStatus table, so that scrubbing a fraction of the archive per run rotates through all of it.
+        Blobs stored in the same pack are checked with a single read of the pack, which is verified as well.
+        The local blob cache is bypassed, so that the copies in the object store are the ones checked.
+
+        Args:
+            objects (ArchiveObject): The object store.
+            data (ArchiveData): The index database holding the scrub status.
+            archive_id (int): The archive whose blobs are scrubbed.
+            workers (int): The number of download threads.
+            rate (float): The bandwidth cap in bytes per second, or 0 for no cap.
+        """
+        self.objects = objects
+        self.data = data
+        self.archive_id = archive_id
+        self.workers = workers
+        self.limiter = BandwidthLimiter(rate)
+        self.nblobs = 0
+        self.nbytes = 0
+        self.nfailed = 0
+        self.ntotal = None  # the number of blobs this run checks, once known
+        self.elapsed = 0.0
+
+    @property
+    def bytes_per_second(self) -> float:
+        return self.nbytes / self.elapsed if self.elapsed > 0 else 0.0
+
+    def _check(self, key : str, members : list) -> tuple:
+        """Fetches a blob or pack and checks its members.
+
+        Returns:
+            tuple(results, nbytes): (hash, message) for each member, with None as the message if it is intact, and
+                the number of bytes fetched.
+        """
+        try:
+            buf = self.objects.get_blob(key, cached=False)
+        except Exception as e:
+            return [(h, f"Unreadable {key}: {e}") for h, _loc in members], 0
+        self.limiter.consume(len(buf))
+        if members[0][1] is not None and self.objects.hash_blob(buf) != key:
+            # a damaged pack damages every blob in it
+            return [(h, f"Hash mismatch in pack {key}") for h, _loc in members], len(buf)
+        view = memoryview(buf)
+        results = []
+        for h, loc in members:
+            blob = view[loc[1]:loc[1]+loc[2]] if loc is not None else view
+            got = self.objects.hash_blob(blob)
+            results.append((h, None if got == h else f"Hash mismatch {h} got {got}"))
+        return results, len(buf)
+
+    def scrub(self, fraction : float = 1.0) -> Iterator[tuple]:
+        """Scrubs the least recently scrubbed fraction of the archive's distinct blobs.
+
+        Args:
+            fraction (float): The share of the blobs to check, between 0 and 1.
+
+        Yields:
+            tuple(hash, message): Each checked blob, with None as the message if it is intact.
+        """
+        t0 = time.perf_counter()
+        total = self.data.count_hashes(self.archive_id)
+        hashes = self.data.read_scrub_queue(self.archive_id, max(1, round(total * fraction)) if total > 0 else 0)
+        self.ntotal = len(hashes)
+
+        fetches = {}    # pack or hash -> [(hash, location in pack)]
+        for h in hashes:
+            loc = self.objects.locate(h)
+            key = loc[0] if loc is not None else h
+            if key not in fetches:
+                fetches[key] = []
+            fetches[key].append((h, loc))
+
+        with ThreadPoolExecutor(self.workers) as pool:
+            pending = set()
+            items = iter(fetches.items())
+            while True:
+                # keep each download thread busy with one read ahead, without queueing the whole archive
+                for key, members in items:
+                    pending.add(pool.submit(self._check, key, members))
+                    if len(pending) >= 2 * self.workers:
+                        break
+                if not pending:
+                    break
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    results, nbytes = future.result()
+                    now = int(time.time())
+                    self.data.write_scrub_status([(h, now, msg is None) for h, msg in results])
+                    self.nbytes += nbytes
+                    for h, msg in results:
+                        self.nblobs += 1
+                        self.objects.metrics.add('blobs_scrubbed')
+                        if msg is not None:
+                            self.nfailed += 1
+                        self.elapsed = time.perf_counter() - t0
+                        yield h, msg
@@ -0,0 +1,181 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator
+import queue
+import random
+import threading
+import time
+from .archive_metrics import ArchiveMetrics
+
+# errors that retrying cannot fix: the object does not exist
+NOT_FOUND = (FileNotFoundError, KeyError)
+
+# errors of the transport that a retry may get past
+TRANSIENT = (ConnectionError, TimeoutError, OSError)
+
+# marks the end of the items of a batch call
+END = object()
+
+
+class ArchiveStore:
+    def __init__(self, backend, connections : int = 8, retries : int = 5, retrydelay : float = 0.5,
+                 maxdelay : float = 30.0, metrics : ArchiveMetrics = None, transient : tuple = ()):
+        """Initialize the I/O layer between the archive and its object store.
+
+        Every request goes through the one backend context, so its client and connections are shared by all the
+        threads of a run, and at most connections requests are in flight at once, whichever threads issue them.
+        Failed requests are retried up to retries times after a random delay of up to retrydelay * 2**attempt
+        seconds (exponential backoff with full jitter, capped at maxdelay), so that a transient error does not
+        abort a long run and clients that failed together do not retry together.  Objects are stored under their
+        content hash, so repeating a put that may have succeeded is harmless, and a delete of an object that is
+        already gone succeeds.  Only transport errors (ConnectionError, TimeoutError and other OSErrors) and the
+        backend's own transient error types are retried; a missing object, and any other error, is raised at once.
+
+        put_many(), get_many(), exists_many() and delete_many() run their requests on a pool of connections threads.
+        The backup and restore pipelines drive put_many() and get_many() with a lazy stream of requests for the whole
+        run, and the results are yielded as they complete.
+
+        Args:
+            backend: The object store, a multicloud context or a stand-in with the same object(path) interface.
+            connections (int): The maximum number of requests in flight.
+            retries (int): The number of times a failed request is retried.
+            retrydelay (float): The base delay in seconds before a retry.
+            maxdelay (float): The maximum delay in seconds before a retry.
+            metrics (ArchiveMetrics): Where retries and failed requests are counted.
+            transient (tuple): Error types of the backend to retry, besides the transport errors.
+        """
+        self.backend = backend
+        self.connections = connections
+        self.retries = retries
+        self.retrydelay = retrydelay
+        self.maxdelay = maxdelay
+        self.metrics = metrics if metrics is not None else ArchiveMetrics()
+        self.slots = threading.BoundedSemaphore(connections)
+        self.transient = TRANSIENT + tuple(transient)
+
+    def _call(self, path : str, request):
+        """Runs request(object) on the object at path, retrying transient errors."""
+        attempt = 0
+        while True:
+            with self.slots:
+                try:
+                    return request(self.backend.object(path))
+                except NOT_FOUND:
+                    raise
+                except self.transient:
+                    if attempt >= self.retries:
+                        self.metrics.add('store_errors')
+                        raise
+            attempt += 1
+            self.metrics.add('store_retries')
+            # sleep without holding a slot, so the other requests keep going
+            time.sleep(random.uniform(0, min(self.maxdelay, self.retrydelay * 2**attempt)))
+
+    def put(self, path : str, data : bytes):
+        self._call(path, lambda o: o.put_bytes(data))
+
+    def get(self, path : str) -> bytes:
+        return self._call(path, lambda o: o.get_bytes())
+
+    def exists(self, path : str) -> bool:
+        return self._call(path, lambda o: o.exists())
+
+    def delete(self, path : str):
+        def request(o):
+            try:
+                o.delete()
+            except NOT_FOUND:
+                # deleted by an earlier attempt whose reply was lost, or by someone else
+                pass
+        self._call(path, request)
+
+    def _map(self, call, items : Iterable, queued : int = None) -> Iterator[tuple]:
+        """Runs call(item) for each item on the pool, yielding (item, result, error) in order of completion.
+
+        Items are consumed lazily on a thread of their own, keeping at most queued requests (twice the number of
+        connections by default) submitted and not yet yielded, so that results are yielded as soon as they complete
+        even while the next item is not ready.  An error raised by the items is raised once the requests submitted
+        before it have been yielded.
+        """
+        queued = queued if queued is not None else 2 * self.connections
+        slots = threading.Semaphore(queued)
+        done = queue.SimpleQueue()  # (item, future) of each completed request, then (END, (count, error))
+        stop = threading.Event()
+        with ThreadPoolExecutor(self.connections) as pool:
+            def feed():
+                count = 0
+                try:
+                    for item in items:
+                        slots.acquire()
+                        if stop.is_set():
+                            break
+                        pool.submit(call, item).add_done_callback(lambda future, item=item: done.put((item, future)))
+                        count += 1
+                except BaseException as e:
+                    done.put((END, (count, e)))
+                    return
+                done.put((END, (count, None)))
+
+            feeder = threading.Thread(target=feed, daemon=True)
+            feeder.start()
+            try:
+                count, failed = None, None
+                received = 0
+                while count is None or received < count:
+                    item, future = done.get()
+                    if item is END:
+                        count, failed = future
+                        continue
+                    received += 1
+                    slots.release()
+                    error = future.exception()
+                    yield item, future.result() if error is None else None, error
+                if failed is not None:
+                    raise failed
+            finally:
+                # wake the feeder if it waits for a slot, and submit nothing more
+                stop.set()
+                slots.release()
+
+    def put_many(self, items : Iterable[tuple]) -> Iterator[tuple]:
+        """Stores (path, data) pairs, yielding (path, error) for each, with None as the error if it was stored."""
+        for (path, _data), _result, error in self._map(lambda item: self.put(*item), items):
+            yield path, error
+
+    def get_many(self, paths : Iterable[str], read=None, queued : int = None) -> Iterator[tuple]:
+        """Reads objects, yielding (path, data, error) for each, with None as the error if it was read.
+
+        Args:
+            paths (Iterable[str]): The paths of the objects.  Consumed lazily.
+            read (callable): Called on the pool with each path in place of get(), such as to serve objects from a
+                local copy, or to decode them and write them out on the thread that read them.  What it returns is
+                yielded as the data.
+            queued (int): The maximum number of requests submitted and not yet yielded, which bounds the objects
+                held in memory.  Defaults to twice the number of connections.
+        """
+        yield from self._map(read if read is not None else self.get, paths, queued)
+
+    def exists_many(self, paths : Iterable[str]) -> dict:
+        """Returns a dictionary of path -> True if the object exists.  A single path is looked up on the calling
+        thread.
+
+        Raises:
+            Exception: The first error of a request that failed all its retries, once the others are done.
+        """
+        paths = list(paths)
+        if len(paths) == 1:
+            return { paths[0]: self.exists(paths[0]) }
+        result = {}
+        first = None
+        for path, exists, error in self._map(self.exists, paths):
+            if error is not None:
+                first = first if first is not None else error
+            else:
+                result[path] = exists
+        if first is not None:
+            raise first
+        return result
+
+    def delete_many(self, paths : Iterable[str]) -> Iterator[tuple]:
+        """Deletes objects, yielding (path, error) for each, with None as the error if it is gone."""
+        for path, _result, error in self._map(self.delete, paths):
+            yield path, error
@@ -0,0 +1,166 @@
+from concurrent.futures import ProcessPoolExecutor, wait
+from collections import deque
+from typing import Iterable, Iterator, List
+import os
+import threading
+import time
+from .archive_chunker import MAXBLOB, read_full
+from .archive_entry import ArchiveEntry
+from .archive_hash import make_hasher
+
+_scratch = threading.local()  # per thread (and per worker process) read buffer
+
+
+def check_file(path : str, size : int, parts : List[tuple], hashalg : str) -> str:
+    """Rehashes a local file and compares it with the parts of its archive entry.
+
+    Args:
+        path (str): The path of the file in the local mirror.
+        size (int): The size of the archived file.
+        parts (List[tuple]): The (part, hash, offset, length) tuples of the entry, see ArchiveEntry.parts().
+        hashalg (str): The content hash algorithm of the archive.
+
+    Returns:
+        str: None if the file matches, otherwise a description of the first difference.
+    """
+    if not os.path.isfile(path):
+        return f"Missing {path}"
+    hasher = make_hasher(hashalg)
+    needed = max([MAXBLOB] + [length for _part, _h, _offset, length in parts])
+    buf = getattr(_scratch, 'buf', None)
+    if buf is None or len(buf) < needed:
+        buf = _scratch.buf = bytearray(needed)
+    total_size = 0
+    with open(path, "rb") as f:
+        for part, expected, offset, length in parts:
+            view = memoryview(buf)[:read_full(f, memoryview(buf)[:length])]
+            h = hasher(view)
+            if h != expected:
+                return f"Hash mismatch {path} part {part} expected {expected} got {h}"
+            total_size += len(view)
+        if len(f.read(1)) > 0:
+            return f"Size mismatch {path} expected {size} got more"
+    if size != total_size:
+        return f"Size mismatch {path} expected {size} got {total_size}"
+    return None
+
+
+def check_stat(path : str, entry : ArchiveEntry) -> str:
+    """Compares the size and mtime of a local file with the stat cache of its archive entry, without reading it.
+
+    Returns:
+        str: None if the file looks unchanged, otherwise a description of the drift.  Entries stored before the
+            stat cache existed are only compared by size.
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return f"Missing {path}"
+    if st.st_size != entry.size:
+        return f"Size mismatch {path} expected {entry.size} got {st.st_size}"
+    if entry.mtime_ns is not None and st.st_mtime_ns != entry.mtime_ns:
+        return f"Modified {path} mtime {entry.mtime_ns} is now {st.st_mtime_ns}"
+    return None
+
+
+class ArchiveVerifier:
+    def __init__(self, objects, data, archive_id : int, workers : int = 4, checkpoint_seconds : float = 30.0):
+        """Verifies the local mirror against the entries of an archive.
+
+        A quick verify only compares each file's size and mtime with the stat cache recorded by the backup,
+        flagging drift without reading file contents.  A deep verify rehashes every file on a pool of worker
+        processes, which read the files themselves so that no file data is passed between processes.  Deep
+        verify results are reported in entry order, and the path of the last reported entry is checkpointed
+        in the VerifyCheckpoint table so that an interrupted run can be resumed.
+
+        Args:
+            objects (ArchiveObject): The object store, used for local paths and the archive's hash algorithm.
+            data (ArchiveData): The index database the checkpoint is kept in.
+            archive_id (int): The archive being verified.
+            workers (int): The number of hashing processes.
+            checkpoint_seconds (float): How often a deep verify records its checkpoint.
+        """
+        self.objects = objects
+        self.data = data
+        self.archive_id = archive_id
+        self.workers = workers
+        self.checkpoint_seconds = checkpoint_seconds
+        self.nfiles = 0
+        self.nbytes = 0
+        self.nfailed = 0
+        self.resumed_bytes = 0  # bytes verified before the checkpoint this run resumed from
+        self.elapsed = 0.0
+
+    @property
+    def bytes_per_second(self) -> float:
+        """The verify throughput of this run."""
+        return (self.nbytes - self.resumed_bytes) / self.elapsed if self.elapsed > 0 else 0.0
+
+    def _count(self, entry : ArchiveEntry, msg : str):
+        self.nfiles += 1
+        self.nbytes += entry.size
+        if msg is not None:
+            self.nfailed += 1
+        self.objects.metrics.add('files_verified')
+        self.objects.metrics.add('bytes_verified', entry.size)
+
+    def quick(self, entries : Iterable[ArchiveEntry]) -> Iterator[tuple]:
+        """Yields (entry, message) for each entry, where message is None if the local file looks unchanged."""
+        t0 = time.perf_counter()
+        for entry in entries:
+            msg = check_stat(self.objects.localpath(entry.libpath), entry)
+            self._count(entry, msg)
+            self.elapsed = time.perf_counter() - t0
+            yield entry, msg
+
+    def deep(self, entries : Iterable[ArchiveEntry], pattern : str = "*", resume : bool = False) -> Iterator[tuple]:
+        """Rehashes the local files of the entries and yields (entry, message) for each one in entry order, where
+        message is None if the file matches.
+
+        Entries must be ordered by libpath for checkpoints to be meaningful.  The checkpoint is deleted when the
+        verify completes.
+
+        Args:
+            entries (Iterable[ArchiveEntry]): The entries to verify, ordered by libpath.
+            pattern (str): The pattern that selected the entries, recorded with the checkpoint.
+            resume (bool): If True, skip the entries up to the checkpoint of an interrupted verify of the same
+                pattern and continue its counts.  Otherwise any checkpoint is discarded.
+        """
+        after = None
+        checkpoint = self.data.read_verify_checkpoint(self.archive_id, pattern) if resume else None
+        if checkpoint is not None:
+            after = checkpoint['libpath']
+            self.nfiles, self.nbytes, self.nfailed = checkpoint['nfiles'], checkpoint['nbytes'], checkpoint['nfailed']
+            self.resumed_bytes = self.nbytes
+        hashalg = self.objects.hashalg
+        pending = deque()
+        t0 = time.perf_counter()
+        last_checkpoint = t0
+
+        def drain(block : bool):
+            nonlocal last_checkpoint
+            while pending and (block or pending[0][1].done()):
+                entry, future = pending.popleft()
+                msg = future.result()
+                self._count(entry, msg)
+                now = time.perf_counter()
+                self.elapsed = now - t0
+                if now - last_checkpoint >= self.checkpoint_seconds:
+                    self.data.write_verify_checkpoint(self.archive_id, pattern, entry.libpath,
+                                                      self.nfiles, self.nbytes, self.nfailed)
+                    last_checkpoint = now
+                yield entry, msg
+
+        with ProcessPoolExecutor(self.workers) as pool:
+            for entry in entries:
+                if after is not None and entry.libpath <= after:
+                    continue
+                future = pool.submit(check_file, self.objects.localpath(entry.libpath), entry.size,
+                                     list(entry.parts()), hashalg)
+                pending.append((entry, future))
+                # keep a few files queued per process, without reading ahead through the whole index
+                if len(pending) >= 4 * self.workers:
+                    wait([pending[0][1]])
+                yield from drain(block=False)
+            yield from drain(block=True)
+        self.data.del_verify_checkpoint(self.archive_id, pattern)